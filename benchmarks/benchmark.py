@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+# Load tests the protected, unprotected and pico servers on localhost so
+# their throughput, and how well each holds up under the attacks in
+# attacks/, can be compared between runs
+# - Every server is started from a fresh copy of its directory, with fixed
+#   settings (SERVERS), once per workload, so no state (bans, logs) carries
+#   over between workloads
+# - Workloads are CONCURRENCY clients sending requests back to back for
+#   DURATION seconds. A request counts as an error when it fails or its
+#   status is not the one expected
+# - Attack workloads start an attack script, give it ATTACK_RAMP_UP seconds
+#   and then measure PROBE_CONCURRENCY legitimate clients while it runs
+# - Each client connection uses its own loopback address (127.1.x.y), as
+#   separate users would, so the per-client defences of the protected
+#   server only see the attack scripts' 127.0.0.1 as one client
+# - Results are written as JSON and compared with a stored baseline. A run
+#   regresses when throughput drops or p99 latency grows by more than
+#   TOLERANCE, or the error rate grows by more than ERROR_RATE_TOLERANCE
+# The servers and attacks all use port 8080, so servers run one at a time
+# and nothing else may be listening on it.
+# Usage: benchmark.py run [servers] [workloads] [duration]
+#        benchmark.py baseline [servers] [workloads] [duration]
+#        benchmark.py compare <results> [baseline]
+#        benchmark.py attack <attack> <duration>
+# Servers and workloads are comma separated names, or 'all'
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import platform
+import tempfile
+import importlib
+import importlib.util
+import threading
+import subprocess
+
+
+HOST, PORT = '127.0.0.1', 8080
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(REPO_DIR, 'benchmarks')
+ATTACKS_DIR = os.path.join(REPO_DIR, 'attacks')
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, 'results.json')
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+RESULTS_VERSION = 1
+
+DURATION = 10
+CONCURRENCY = 16
+PROBE_CONCURRENCY = 4
+ATTACK_RAMP_UP = 2
+CLIENT_TIMEOUT = 10
+# Pause after a failed connection, so a refusing server is not spun on
+FAILURE_BACKOFF = 0.05
+CLIENT_ADDRESSES = 4096
+RECV_SIZE = 65536
+
+STARTUP_TIMEOUT = 10
+STOP_TIMEOUT = 5
+TOLERANCE = 0.2
+ERROR_RATE_TOLERANCE = 0.05
+PERCENTILES = (50, 90, 99, 99.9)
+
+# name: (directory, script, arguments, standard input)
+SERVERS = {
+    'protected': ('server/protected', 'tcp_server.py', ['threaded', '1', '1000'], b''),
+    'unprotected': ('server/unprotected', 'tcp_server.py', [], b'1000\n'),
+    'pico': ('server/experiments', 'pico_tcp_server.py', [], b'')
+}
+
+# name: (keep-alive, [(method, path, expected status)], attack)
+WORKLOADS = {
+    'get_close': (False, [('GET', '/', 200)], None),
+    'get_keepalive': (True, [('GET', '/', 200)], None),
+    'mixed': (False, [
+        ('GET', '/', 200),
+        ('HEAD', '/', 200),
+        ('GET', '/index.html', 200),
+        ('GET', '/no-such-page.html', 404)
+    ], None),
+    'basic_dos': (False, [('GET', '/', 200)], 'basic_dos'),
+    'slowloris': (False, [('GET', '/', 200)], 'slowloris'),
+    'syn_flood': (False, [('GET', '/', 200)], 'syn_flood')
+}
+
+# name: (module, function, settings, threads, needs root). Attacks run
+# without threads of their own are called once and stopped with SIGINT
+ATTACKS = {
+    'basic_dos': ('basic_dos', 'run_dos', {'NUM_THREADS': 500}, 0, False),
+    'slowloris': ('slowloris_dos', 'slowloris_attack', {'NUM_SOCKETS': 50}, 0, False),
+    'syn_flood': ('syn_flood', 'syn_flood', {}, 50, True)
+}
+
+
+class ClientStats:
+    # Written only by its own client thread, merged once all have finished
+    __slots__ = ('latencies', 'statuses', 'failures', 'unexpected', 'connections')
+
+    def __init__(self) -> None:
+        # Latencies of the responses, failures counted by exception
+        self.latencies = []
+        self.statuses = {}
+        self.failures = {}
+        self.unexpected = 0
+        self.connections = 0
+
+
+class Connection:
+    def __init__(self, address: str) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(CLIENT_TIMEOUT)
+        try:
+            self.sock.bind((address, 0))
+        except OSError:
+            # Only Linux routes all of 127.0.0.0/8 to loopback
+            pass
+        self.sock.connect((HOST, PORT))
+        self.buffer = b''
+
+    def request(self, method: str, path: str, keep_alive: bool) -> tuple[int, bool]:
+        # Returns the response status and whether the connection can be
+        # used again
+        self.sock.sendall(
+            f'{method} {path} HTTP/1.1\r\nHost: {HOST}:{PORT}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+            .encode()
+        )
+
+        head = self._read_until(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status_line = lines[0].split(' ', 2)
+        if len(status_line) < 2 or not status_line[1].isdecimal():
+            raise ConnectionError(f'Invalid status line: {lines[0]!r}')
+        status = int(status_line[1])
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        reusable = keep_alive and headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304):
+            return status, reusable
+
+        if 'content-length' in headers:
+            self._read_exactly(int(headers['content-length']))
+        else:
+            # Delimited by the server closing the connection
+            while self._receive():
+                self.buffer = b''
+            reusable = False
+        return status, reusable
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def _receive(self) -> bool:
+        data = self.sock.recv(RECV_SIZE)
+        self.buffer += data
+        return bool(data)
+
+    def _read_until(self, delimiter: bytes) -> bytes:
+        while delimiter not in self.buffer:
+            if not self._receive():
+                raise ConnectionError('Connection closed before the response')
+        data, _, self.buffer = self.buffer.partition(delimiter)
+        return data
+
+    def _read_exactly(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not self._receive():
+                raise ConnectionError('Connection closed mid-response')
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def client_address(index: int) -> str:
+    index = index % CLIENT_ADDRESSES + 1
+    return f'127.1.{index >> 8}.{index & 0xFF}'
+
+
+def run_client(
+    client: int,
+    keep_alive: bool,
+    requests: list,
+    deadline: float,
+    stats: ClientStats,
+    concurrency: int
+) -> None:
+    # Sends requests back to back until the deadline. Clients take turns
+    # through the address space, one address per connection
+    connection = None
+    sent = 0
+    while time.monotonic() < deadline:
+        method, path, expected = requests[sent % len(requests)]
+        sent += 1
+
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                address = client_address(client + stats.connections * concurrency)
+                stats.connections += 1
+                connection = Connection(address)
+            status, reusable = connection.request(method, path, keep_alive)
+        except OSError as error:
+            name = type(error).__name__
+            stats.failures[name] = stats.failures.get(name, 0) + 1
+            if connection is not None:
+                connection.close()
+                connection = None
+            time.sleep(FAILURE_BACKOFF)
+            continue
+
+        stats.latencies.append(time.perf_counter() - start)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        if status != expected:
+            stats.unexpected += 1
+        if not reusable:
+            connection.close()
+            connection = None
+
+    if connection is not None:
+        connection.close()
+
+
+def drive_load(keep_alive: bool, requests: list, duration: float, concurrency: int) -> dict:
+    deadline = time.monotonic() + duration
+    client_stats = [ClientStats() for _ in range(concurrency)]
+    clients = [
+        threading.Thread(
+            target=run_client,
+            args=(client, keep_alive, requests, deadline, stats, concurrency),
+            daemon=True
+        )
+        for client, stats in enumerate(client_stats)
+    ]
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    latencies, statuses, failures = [], {}, {}
+    unexpected = connections = 0
+    for stats in client_stats:
+        latencies += stats.latencies
+        for status, count in stats.statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+        for name, count in stats.failures.items():
+            failures[name] = failures.get(name, 0) + count
+        unexpected += stats.unexpected
+        connections += stats.connections
+
+    attempted = len(latencies) + sum(failures.values())
+    errors = unexpected + sum(failures.values())
+    return {
+        'requests': attempted,
+        'responses': len(latencies),
+        'errors': errors,
+        'error_rate': errors / attempted if attempted else 1.0,
+        # Only responses with the expected status count
+        'throughput': (len(latencies) - unexpected) / elapsed,
+        'connections': connections,
+        'elapsed': elapsed,
+        'latency_ms': percentiles(latencies),
+        'statuses': statuses,
+        'failures': failures
+    }
+
+
+def percentiles(latencies: list[float]) -> dict:
+    # Nearest rank, in milliseconds
+    if not latencies:
+        return {}
+    latencies = sorted(latencies)
+    values = {
+        f'p{percentile:g}': latencies[
+            min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+        ] * 1000
+        for percentile in PERCENTILES
+    }
+    values['max'] = latencies[-1] * 1000
+    return values
+
+
+class ServerProcess:
+    # Runs a server from a temporary copy of its directory, so its logs and
+    # state stay out of the repository and start empty every time
+    def __init__(self, name: str) -> None:
+        directory, script, arguments, stdin = SERVERS[name]
+        self.name = name
+        self.directory = tempfile.mkdtemp(prefix=f'benchmark-{name}-')
+        shutil.copytree(
+            os.path.join(REPO_DIR, directory), self.directory, dirs_exist_ok=True,
+            ignore=shutil.ignore_patterns(
+                '__pycache__', '*.txt', 'access_logs', 'profiles'
+            )
+        )
+
+        self.process = subprocess.Popen(
+            [sys.executable, script, *arguments],
+            cwd=self.directory,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env={**os.environ, 'NO_COLOR': '1'},
+            start_new_session=True
+        )
+        self.process.stdin.write(stdin)
+        self.process.stdin.close()
+
+    def wait_until_serving(self) -> bool:
+        # Waits for an answer to a HEAD request. A bare connect is not
+        # enough, the pico server crashes on connections closed unused
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                return False
+            try:
+                connection = Connection(client_address(0))
+                try:
+                    connection.request('HEAD', '/', False)
+                    return True
+                finally:
+                    connection.close()
+            except OSError:
+                time.sleep(0.1)
+        return False
+
+    def running(self) -> bool:
+        return self.process.poll() is None
+
+    def stop(self) -> None:
+        stop_process(self.process)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def stop_process(process: subprocess.Popen) -> None:
+    # SIGINT first, as the scripts shut down on KeyboardInterrupt
+    for sig in (signal.SIGINT, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(STOP_TIMEOUT)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def port_in_use() -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(1)
+        return sock.connect_ex((HOST, PORT)) == 0
+
+
+def attack_unavailable(attack: str) -> str | None:
+    module, _, _, _, needs_root = ATTACKS[attack]
+    if needs_root and os.geteuid() != 0:
+        return 'needs root'
+    if module == 'syn_flood' and importlib.util.find_spec('scapy') is None:
+        return 'needs scapy'
+    return None
+
+
+def start_attack(attack: str, duration: float) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'attack', attack, str(duration)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+def run_attack(attack: str, duration: float) -> None:
+    # Runs an attack script's own attack function with the benchmark's
+    # settings, for duration seconds or until interrupted
+    module_name, function, settings, threads, _ = ATTACKS[attack]
+    sys.path.insert(0, ATTACKS_DIR)
+    module = importlib.import_module(module_name)
+    module.TARGET_HOST, module.TARGET_PORT = HOST, PORT
+    if hasattr(module, 'MAX_DURATION'):
+        module.MAX_DURATION = duration
+    for name, value in settings.items():
+        setattr(module, name, value)
+
+    attack_function = getattr(module, function)
+    if not threads:
+        return attack_function()
+
+    for _ in range(threads):
+        threading.Thread(target=attack_function, daemon=True).start()
+    time.sleep(duration)
+
+
+def run_workload(server: str, workload: str, duration: float) -> dict:
+    keep_alive, requests, attack = WORKLOADS[workload]
+    if attack is not None:
+        reason = attack_unavailable(attack)
+        if reason is not None:
+            return {'skipped': reason}
+
+    process = ServerProcess(server)
+    attacker = None
+    try:
+        if not process.wait_until_serving():
+            return {'skipped': f'server did not start (exit code {process.process.poll()})'}
+
+        if attack is None:
+            return drive_load(keep_alive, requests, duration, CONCURRENCY)
+
+        attacker = start_attack(attack, ATTACK_RAMP_UP + duration)
+        time.sleep(ATTACK_RAMP_UP)
+        result = drive_load(keep_alive, requests, duration, PROBE_CONCURRENCY)
+        result['server_survived'] = process.running()
+        return result
+
+    finally:
+        if attacker is not None:
+            stop_process(attacker)
+        process.stop()
+
+
+def run_benchmarks(servers: list[str], workloads: list[str], duration: float) -> dict:
+    if port_in_use():
+        exit(f'Port {PORT} is already in use, stop whatever is listening on it first')
+
+    results = {}
+    for server in servers:
+        results[server] = {}
+        for workload in workloads:
+            print(f'{server} / {workload} ...', flush=True)
+            result = run_workload(server, workload, duration)
+            results[server][workload] = result
+            print(f'  {summarise(result)}', flush=True)
+
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'settings': {
+            'duration': duration,
+            'concurrency': CONCURRENCY,
+            'probe_concurrency': PROBE_CONCURRENCY,
+            'attack_ramp_up': ATTACK_RAMP_UP,
+            'servers': {name: SERVERS[name][2] for name in servers}
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        },
+        'results': results
+    }
+
+
+def summarise(result: dict) -> str:
+    if 'skipped' in result:
+        return f'skipped: {result["skipped"]}'
+    latency = result['latency_ms']
+    summary = (
+        f'{result["throughput"]:.1f} ok/s  errors {result["error_rate"]:.1%}'
+        f'  p50 {latency.get("p50", 0):.1f}ms  p99 {latency.get("p99", 0):.1f}ms'
+    )
+    if 'server_survived' in result and not result['server_survived']:
+        summary += '  server died'
+    return summary
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    # Prints the change of every workload in both runs, and returns the
+    # regressions
+    if results['settings'] != baseline['settings']:
+        print('Warning: the baseline was run with different settings')
+
+    regressions = []
+    for server, workloads in results['results'].items():
+        for workload, current in workloads.items():
+            previous = baseline['results'].get(server, {}).get(workload)
+            if previous is None or 'skipped' in previous or 'skipped' in current:
+                continue
+
+            name = f'{server}/{workload}'
+            throughput = (current['throughput'], previous['throughput'])
+            error_rate = (current['error_rate'], previous['error_rate'])
+            p99 = (
+                current['latency_ms'].get('p99', 0.0),
+                previous['latency_ms'].get('p99', 0.0)
+            )
+            print(
+                f'{name:<28} throughput {throughput[1]:.1f} -> {throughput[0]:.1f}'
+                f' ({_change(*throughput)})  errors {error_rate[1]:.1%} -> {error_rate[0]:.1%}'
+                f'  p99 {p99[1]:.1f} -> {p99[0]:.1f}ms ({_change(*p99)})'
+            )
+
+            if throughput[0] < throughput[1] * (1 - TOLERANCE):
+                regressions.append(f'{name}: throughput fell {_change(*throughput)}')
+            if error_rate[0] > error_rate[1] + ERROR_RATE_TOLERANCE:
+                regressions.append(
+                    f'{name}: error rate rose from {error_rate[1]:.1%} to {error_rate[0]:.1%}'
+                )
+            if p99[0] > p99[1] * (1 + TOLERANCE):
+                regressions.append(f'{name}: p99 latency rose {_change(*p99)}')
+            if previous.get('server_survived', True) and not current.get('server_survived', True):
+                regressions.append(f'{name}: server no longer survives the attack')
+    return regressions
+
+
+def _change(current: float, previous: float) -> str:
+    if not previous:
+        return 'n/a'
+    return f'{(current - previous) / previous:+.0%}'
+
+
+def _select(argument: str | None, names: dict) -> list[str]:
+    if argument is None or argument == 'all':
+        return list(names)
+    selected = argument.split(',')
+    for name in selected:
+        if name not in names:
+            exit(f'Invalid input: {name} is not one of {", ".join(names)}')
+    return selected
+
+
+def _load(path: str) -> dict:
+    try:
+        with open(path) as f:
+            results = json.load(f)
+    except (OSError, ValueError) as error:
+        exit(f'Could not read {path}: {error}')
+    if results.get('version') != RESULTS_VERSION:
+        exit(f'{path} is not a version {RESULTS_VERSION} results file')
+    return results
+
+
+def _write(path: str, results: dict) -> None:
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+    print(f'Results written to {path}')
+
+
+def _compare_files(results_path: str, baseline_path: str) -> None:
+    regressions = compare(_load(results_path), _load(baseline_path))
+    if regressions:
+        print(f'\nRegressions ({len(regressions)}):')
+        for regression in regressions:
+            print(f'  {regression}')
+        exit(1)
+    print('\nNo regressions')
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+
+    if command in ('run', 'baseline'):
+        servers = _select(sys.argv[2] if len(sys.argv) > 2 else None, SERVERS)
+        workloads = _select(sys.argv[3] if len(sys.argv) > 3 else None, WORKLOADS)
+        try:
+            duration = float(sys.argv[4]) if len(sys.argv) > 4 else DURATION
+        except ValueError:
+            exit('Invalid input: Duration must be a number')
+
+        results = run_benchmarks(servers, workloads, duration)
+        if command == 'baseline':
+            _write(BASELINE_FILE, results)
+        else:
+            _write(RESULTS_FILE, results)
+            if os.path.exists(BASELINE_FILE):
+                _compare_files(RESULTS_FILE, BASELINE_FILE)
+
+    elif command == 'compare':
+        if len(sys.argv) < 3:
+            exit('Usage: benchmark.py compare <results> [baseline]')
+        _compare_files(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else BASELINE_FILE)
+
+    elif command == 'attack':
+        if len(sys.argv) < 4 or sys.argv[2] not in ATTACKS:
+            exit(f'Usage: benchmark.py attack <{"|".join(ATTACKS)}> <duration>')
+        try:
+            run_attack(sys.argv[2], float(sys.argv[3]))
+        except KeyboardInterrupt:
+            pass
+
+    else:
+        exit(f'Invalid input: {command} is not run, baseline, compare or attack')
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Binary access log with one fixed-size record per response, so traffic can
+# be analysed after an attack without parsing text (see analyze_access_log.py)
+# - A record (RECORD) holds the time, client IPv4 address, method, path id,
+#   status, response bytes and latency in microseconds
+# - Paths are stored as their CRC-32. Each process appends the first
+#   MAX_INDEXED_PATHS paths it sees to the PATH_INDEX file, so a flood of
+#   random paths cannot grow the index without bound
+# - Records are packed into a buffer and written by a flusher thread every
+#   FLUSH_INTERVAL seconds, or as soon as FLUSH_SIZE bytes wait
+# - Each process writes its own files, access-<start ms>-<pid>.bin, and
+#   moves to a new one once the current file reaches MAX_FILE_SIZE bytes or
+#   MAX_FILE_AGE seconds. Only the newest MAX_FILES files are kept
+# Every file starts with FILE_HEADER: magic, format version and record size
+import os
+import glob
+import time
+import zlib
+import socket
+import struct
+import threading
+
+from threads import start_thread
+
+
+ACCESS_LOG_DIR = 'access_logs'
+PATH_INDEX = 'paths.tsv'
+MAX_FILE_SIZE = 64 * 1024 * 1024
+MAX_FILE_AGE = 3600
+MAX_FILES = 48
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 64 * 1024
+MAX_INDEXED_PATHS = 10000
+
+MAGIC = b'ACCLOG'
+VERSION = 1
+FILE_HEADER = struct.Struct('<6sHI')
+# time, client, method, path id, status, bytes, latency (µs). Packed
+# little-endian without padding, 31 bytes
+RECORD = struct.Struct('<dIBIHQI')
+
+# Method codes, 0 for unknown methods and unparsed requests
+METHODS = ('-', 'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH', 'TRACE', 'CONNECT')
+METHOD_CODES = {method: code for code, method in enumerate(METHODS)}
+MAX_LATENCY_US = 0xFFFFFFFF
+
+
+def path_id(path: str) -> int:
+    # Paths are decoded as latin-1 by the request parser
+    return zlib.crc32(path.encode('latin-1', 'replace'))
+
+
+class AccessLog:
+    def __init__(
+        self,
+        directory: str = ACCESS_LOG_DIR,
+        max_file_size: int = MAX_FILE_SIZE,
+        max_file_age: float = MAX_FILE_AGE,
+        max_files: int = MAX_FILES
+    ) -> None:
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.max_file_age = max_file_age
+        self.max_files = max_files
+        os.makedirs(directory, exist_ok=True)
+
+        self.buffer = bytearray()
+        self.new_paths = []
+        self.indexed = set()
+        self.lock = threading.Lock()
+
+        self.file = None
+        self.file_size = 0
+        self.file_opened = 0.0
+        self.records = 0
+
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.flusher = start_thread(self._run, name='access-log')
+
+    def record(
+        self,
+        client: str,
+        method: str,
+        path: str,
+        status_code: int,
+        length: int,
+        latency: float
+    ) -> None:
+        # Only packs the record, the flusher thread writes it
+        try:
+            address = struct.unpack('!I', socket.inet_aton(client))[0]
+        except OSError:
+            address = 0
+        request_path = path_id(path)
+        record = RECORD.pack(
+            time.time(), address, METHOD_CODES.get(method, 0), request_path,
+            status_code, length, min(int(latency * 1e6), MAX_LATENCY_US)
+        )
+
+        with self.lock:
+            self.buffer += record
+            if request_path not in self.indexed and len(self.indexed) < MAX_INDEXED_PATHS:
+                self.indexed.add(request_path)
+                self.new_paths.append((request_path, path))
+            full = len(self.buffer) >= FLUSH_SIZE
+        if full:
+            self.wakeup.set()
+
+    def close(self) -> None:
+        # Writes what is still buffered and stops the flusher
+        self.stopping = True
+        self.wakeup.set()
+        self.flusher.join()
+
+    def stats(self) -> dict:
+        return {
+            'records': self.records,
+            'file': self.file.name if self.file is not None else None,
+            'file_size': self.file_size
+        }
+
+    def _run(self) -> None:
+        while True:
+            self.wakeup.wait(FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self._flush()
+            if self.stopping:
+                self._flush()
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def _flush(self) -> None:
+        with self.lock:
+            data, self.buffer = self.buffer, bytearray()
+            new_paths, self.new_paths = self.new_paths, []
+
+        if new_paths:
+            index = ''.join(
+                f'{request_path}\t{path.replace(chr(9), "%09")}\n'
+                for request_path, path in new_paths
+            )
+            with open(os.path.join(self.directory, PATH_INDEX), 'a') as f:
+                f.write(index)
+
+        if not data:
+            return
+
+        # A batch always goes to one file, which may end up a batch over
+        # the size limit
+        if (
+            self.file is None
+            or self.file_size >= self.max_file_size
+            or time.monotonic() - self.file_opened >= self.max_file_age
+        ):
+            self._rotate()
+
+        self.file.write(data)
+        self.file.flush()
+        self.file_size += len(data)
+        self.records += len(data) // RECORD.size
+
+    def _rotate(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+        name = f'access-{time.time_ns() // 1_000_000:013d}-{os.getpid()}.bin'
+        self.file = open(os.path.join(self.directory, name), 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.file_size = FILE_HEADER.size
+        self.file_opened = time.monotonic()
+
+        # Names sort by start time, oldest first
+        files = sorted(glob.glob(os.path.join(self.directory, 'access-*.bin')))
+        for old in files[:-self.max_files]:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
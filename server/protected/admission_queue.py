@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Bounded queue of accepted connections waiting for a free connection slot.
+# A burst beyond the server's limit waits a little instead of being reset:
+# - Each connection has a priority class, lower numbers first. Classes are
+#   served in order and each class is FIFO
+# - At most MAX_QUEUE_DEPTH connections wait. A full queue makes room by
+#   dropping the newest connection of a lower class, and otherwise refuses
+# - No connection waits longer than MAX_QUEUE_WAIT seconds
+# - CoDel-style shedding: once every connection leaving the queue has waited
+#   more than TARGET_DELAY for a whole INTERVAL, the queue is standing rather
+#   than absorbing a burst, and connections are dropped at an increasing
+#   rate (INTERVAL / sqrt(drops) apart) until waits fall below the target.
+#   Shedding also takes the newest connection of the lowest class waiting
+# - Reputations change while connections wait, so reclassify() moves each
+#   one to the class it would get now, or removes it
+# Queue depth and wait times are kept in stats()
+import math
+import time
+import threading
+from collections import deque
+
+
+MAX_QUEUE_DEPTH = 128
+NUM_PRIORITIES = 3
+MAX_QUEUE_WAIT = 10.0
+TARGET_DELAY = 2.0
+INTERVAL = 10.0
+
+# Weight of the newest wait in the moving average
+WAIT_SMOOTHING = 0.1
+
+
+class AdmissionQueue:
+    def __init__(
+        self,
+        max_depth: int = MAX_QUEUE_DEPTH,
+        max_wait: float = MAX_QUEUE_WAIT,
+        target_delay: float = TARGET_DELAY,
+        interval: float = INTERVAL,
+        num_priorities: int = NUM_PRIORITIES
+    ) -> None:
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.target_delay = target_delay
+        self.interval = interval
+
+        # (enqueued, item) per priority class, oldest first
+        self.entries = [deque() for _ in range(num_priorities)]
+        self.depth = 0
+        self.lock = threading.Lock()
+
+        # CoDel state: when waits first went above target, and while
+        # dropping, the number of drops and time of the next one
+        self.first_above = 0.0
+        self.dropping = False
+        self.drop_count = 0
+        self.drop_next = 0.0
+
+        self.enqueued = 0
+        self.admitted = 0
+        self.overflowed = 0
+        self.expired = 0
+        self.shed = 0
+        self.removed = 0
+        self.average_wait = 0.0
+        self.max_seen_wait = 0.0
+
+    def enqueue(
+        self,
+        item,
+        priority: int = 0,
+        now: float | None = None
+    ) -> list:
+        # Returns the items dropped to make room, which the caller must
+        # close. This is the item itself if the queue is full of items of
+        # its priority or higher
+        if now is None:
+            now = time.monotonic()
+
+        dropped = []
+        with self.lock:
+            if self.depth >= self.max_depth:
+                if self._lowest_class() <= priority:
+                    self.overflowed += 1
+                    return [item]
+                dropped.append(self._pop_newest())
+                self.shed += 1
+
+            self.entries[priority].append((now, item))
+            self.depth += 1
+            self.enqueued += 1
+        return dropped
+
+    def dequeue(self, now: float | None = None) -> tuple[object | None, list]:
+        # Returns the next item to admit, or None if there is none, along
+        # with the items dropped on the way, which the caller must close
+        if now is None:
+            now = time.monotonic()
+
+        dropped = []
+        with self.lock:
+            while self.depth:
+                entries = next(entries for entries in self.entries if entries)
+                enqueued, item = entries[0]
+                wait = now - enqueued
+
+                if wait > self.max_wait:
+                    entries.popleft()
+                    self.depth -= 1
+                    self.expired += 1
+                    dropped.append(item)
+                    continue
+
+                if self._should_drop(wait, now):
+                    self.shed += 1
+                    dropped.append(self._pop_newest())
+                    continue
+
+                entries.popleft()
+                self.depth -= 1
+                self.admitted += 1
+                self.average_wait += (wait - self.average_wait) * WAIT_SMOOTHING
+                self.max_seen_wait = max(self.max_seen_wait, wait)
+                return item, dropped
+
+        return None, dropped
+
+    def expire(self, now: float | None = None) -> list:
+        # Removes and returns items that waited longer than max_wait. Each
+        # class is FIFO, so they are all at the front of their class
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self.lock:
+            for entries in self.entries:
+                while entries and now - entries[0][0] > self.max_wait:
+                    expired.append(entries.popleft()[1])
+            self.depth -= len(expired)
+            self.expired += len(expired)
+        return expired
+
+    def reclassify(self, classify) -> list:
+        # Moves every waiting item to the class classify(item) returns, or
+        # removes it if that is None. Items keep their place in line by
+        # the time they were queued. Returns the removed items, which the
+        # caller must close
+        removed = []
+        with self.lock:
+            classes = [[] for _ in self.entries]
+            for entries in self.entries:
+                for enqueued, item in entries:
+                    priority = classify(item)
+                    if priority is None:
+                        removed.append(item)
+                    else:
+                        classes[priority].append((enqueued, item))
+
+            for entries, reclassified in zip(self.entries, classes):
+                entries.clear()
+                entries.extend(sorted(reclassified, key=lambda entry: entry[0]))
+            self.depth -= len(removed)
+            self.removed += len(removed)
+        return removed
+
+    def clear(self) -> list:
+        # Removes and returns every waiting item, for shutdown
+        with self.lock:
+            items = [item for entries in self.entries for _, item in entries]
+            for entries in self.entries:
+                entries.clear()
+            self.depth = 0
+        return items
+
+    def stats(self) -> dict:
+        with self.lock:
+            oldest = min(
+                (entries[0][0] for entries in self.entries if entries),
+                default=None
+            )
+            return {
+                'depth': self.depth,
+                'depth_by_priority': [len(entries) for entries in self.entries],
+                'oldest_wait': time.monotonic() - oldest if oldest is not None else 0.0,
+                'average_wait': self.average_wait,
+                'max_wait': self.max_seen_wait,
+                'enqueued': self.enqueued,
+                'admitted': self.admitted,
+                'overflowed': self.overflowed,
+                'expired': self.expired,
+                'shed': self.shed,
+                'removed': self.removed
+            }
+
+    def __len__(self) -> int:
+        return self.depth
+
+    def _lowest_class(self) -> int:
+        # Lowest priority class with waiting items. Needs the lock
+        return max(
+            (priority for priority, entries in enumerate(self.entries) if entries),
+            default=-1
+        )
+
+    def _pop_newest(self):
+        # Removes the most recently queued item of the lowest priority
+        # class waiting. Needs the lock and a non-empty queue
+        self.depth -= 1
+        return self.entries[self._lowest_class()].pop()[1]
+
+    def _should_drop(self, wait: float, now: float) -> bool:
+        # CoDel control law, applied to the wait of each item leaving the
+        # queue. Needs the lock
+        if wait < self.target_delay:
+            self.first_above = 0.0
+            self.dropping = False
+            return False
+
+        if not self.first_above:
+            self.first_above = now + self.interval
+            return False
+        if now < self.first_above:
+            return False
+
+        if not self.dropping:
+            # Resume near the previous drop rate if dropping stopped recently
+            recent = now - self.drop_next < self.interval
+            self.drop_count = max(self.drop_count - 2, 1) if recent else 1
+            self.dropping = True
+        elif now < self.drop_next:
+            return False
+        else:
+            self.drop_count += 1
+
+        self.drop_next = now + self.interval / math.sqrt(self.drop_count)
+        return True
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Offline analysis of the binary access log written by access_log.py.
+# Each file is memory-mapped as an array of records and every statistic is
+# a vectorised NumPy scan, so hours of flood traffic take seconds. Reports:
+# - Request rate overall, and the busiest clients by request count and by
+#   peak rate (requests in their busiest second)
+# - Responses by status code, method and path
+# - Latency percentiles, overall and per status class
+# Needs NumPy, which the server itself does not.
+# Usage: analyze_access_log.py [directory] [top]
+import os
+import sys
+import glob
+import socket
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from access_log import (
+    ACCESS_LOG_DIR, FILE_HEADER, MAGIC, METHODS, PATH_INDEX, RECORD, VERSION
+)
+
+
+TOP = 10
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Same layout as access_log.RECORD, NumPy does not pad it
+RECORD_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('client', '<u4'),
+    ('method', 'u1'),
+    ('path', '<u4'),
+    ('status', '<u2'),
+    ('bytes', '<u8'),
+    ('latency', '<u4')
+]) if np is not None else None
+
+
+def load(directory: str) -> list:
+    # Memory maps of the records of every log file, oldest first
+    maps = []
+    for path in sorted(glob.glob(os.path.join(directory, 'access-*.bin'))):
+        with open(path, 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            continue
+
+        magic, version, record_size = FILE_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            print(f'Skipping {path}: not a version {VERSION} access log')
+            continue
+
+        # A file still being written may end in a partial record
+        count = (os.path.getsize(path) - FILE_HEADER.size) // RECORD.size
+        if count:
+            maps.append(np.memmap(
+                path, dtype=RECORD_DTYPE, mode='r',
+                offset=FILE_HEADER.size, shape=(count,)
+            ))
+    return maps
+
+
+def load_path_index(directory: str) -> dict[int, str]:
+    paths = {}
+    try:
+        with open(os.path.join(directory, PATH_INDEX)) as f:
+            for line in f:
+                request_path, _, path = line.rstrip('\n').partition('\t')
+                paths[int(request_path)] = path
+    except FileNotFoundError:
+        pass
+    return paths
+
+
+def analyze(directory: str, top: int = TOP) -> None:
+    maps = load(directory)
+    if not maps:
+        return print(f'No access log records in {directory}')
+
+    def column(name: str):
+        # Only the columns used are read, the rest stays on disk
+        return np.concatenate([records[name] for records in maps])
+
+    times = column('time')
+    clients = column('client')
+    statuses = column('status')
+    latencies = column('latency') / 1000.0
+
+    total = len(times)
+    span = max(float(times.max() - times.min()), 1.0)
+    print(f'{total} requests over {span:.0f}s ({total / span:.1f}/s)')
+    print(f'{int(column("bytes").sum())} bytes sent')
+
+    # Requests per client, and per client and second for peak rates
+    addresses, counts = np.unique(clients, return_counts=True)
+    seconds = (times - times.min()).astype(np.uint64)
+    keys, per_second = np.unique(
+        (clients.astype(np.uint64) << np.uint64(32)) | seconds,
+        return_counts=True
+    )
+    peaks = np.zeros(len(addresses), dtype=np.int64)
+    np.maximum.at(
+        peaks,
+        np.searchsorted(addresses, (keys >> np.uint64(32)).astype(np.uint32)),
+        per_second
+    )
+
+    print(f'\n{len(addresses)} clients, busiest:')
+    for index in np.argsort(counts)[::-1][:top]:
+        print(
+            f'  {_address(addresses[index]):<15} {counts[index]:>10} requests'
+            f'  peak {peaks[index]}/s  average {counts[index] / span:.1f}/s'
+        )
+
+    print('\nStatus codes:')
+    for status, count in zip(*np.unique(statuses, return_counts=True)):
+        print(f'  {status:<5} {count:>10}  {count / total:6.1%}')
+
+    print('\nMethods:')
+    for method, count in zip(*np.unique(column('method'), return_counts=True)):
+        name = METHODS[method] if method < len(METHODS) else '?'
+        print(f'  {name:<7} {count:>10}')
+
+    path_names = load_path_index(directory)
+    paths, path_counts = np.unique(column('path'), return_counts=True)
+    print(f'\n{len(paths)} paths, most requested:')
+    for index in np.argsort(path_counts)[::-1][:top]:
+        name = path_names.get(int(paths[index]), f'<{paths[index]:08x}>') or '-'
+        print(f'  {path_counts[index]:>10}  {name}')
+
+    print('\nLatency percentiles (ms):')
+    print(f'  {"all":<5} {_percentiles(latencies)}')
+    classes = statuses // 100
+    for status_class in np.unique(classes):
+        selected = latencies[classes == status_class]
+        print(f'  {status_class}xx   {_percentiles(selected)}')
+
+
+def _percentiles(latencies) -> str:
+    values = np.percentile(latencies, PERCENTILES)
+    return '  '.join(
+        f'p{percentile:g}={value:.1f}'
+        for percentile, value in zip(PERCENTILES, values)
+    )
+
+
+def _address(client) -> str:
+    return socket.inet_ntoa(struct.pack('!I', int(client)))
+
+
+if __name__ == '__main__':
+    if np is None:
+        exit('The access log analyzer requires NumPy (pip install numpy)')
+
+    directory = sys.argv[1] if len(sys.argv) > 1 else ACCESS_LOG_DIR
+    try:
+        top = int(sys.argv[2]) if len(sys.argv) > 2 else TOP
+    except ValueError:
+        exit('Invalid input: top must be an integer')
+
+    analyze(directory, top)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# Shared in-memory cache of the static files served by the handler.
+# Entries are keyed by the resolved request path and hold the file's bytes,
+# size, content type and a prebuilt, encoded response head, so a cache hit
+# needs no filesystem access or header formatting at all.
+# - Entries are revalidated against the file's mtime and inode at most once
+#   every REVALIDATE_INTERVAL seconds
+# - The least recently used entries are evicted to stay under the byte budget
+# - Files larger than the per-entry limit only cache their metadata, and
+#   their bodies are still sent from the page cache with sendfile
+# - Each version of a file gets a strong ETag and Last-Modified date for
+#   conditional requests, hashed from the content when it is held in memory
+#   and from the inode, size and mtime otherwise, and the Cache-Control
+#   policy of the first pattern in cache_control matching its path
+# - Compressible bodies get gzip (and brotli) variants built once per
+#   version, each with its own head and ETag. select() picks one from the
+#   request's Accept-Encoding and every head of such an asset sends
+#   Vary: Accept-Encoding
+# - Full responses advertise byte ranges, and every representation also
+#   keeps the start of a 206 Partial Content head for range requests
+import os
+import time
+import hashlib
+import fnmatch
+import mimetypes
+import threading
+from email.utils import formatdate
+from collections import OrderedDict
+from stat import S_ISREG
+
+from compression import compress_variants, negotiate
+from response_templates import STATUS_LINES
+
+
+CACHE_BYTE_BUDGET = 64 * 1024 * 1024
+CACHE_MAX_ENTRY_SIZE = 1024 * 1024
+REVALIDATE_INTERVAL = 1.0
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+class EncodedVariant:
+    # A compressed representation of a cached asset. It has the attributes
+    # of CachedAsset the handler sends, so either can be served the same way
+    __slots__ = (
+        'encoding', 'size', 'body', 'etag', 'header_block',
+        'response_head', 'not_modified_head', 'partial_head'
+    )
+
+    def __init__(
+        self,
+        encoding: str,
+        body: bytes,
+        etag: str,
+        content_type: str,
+        validators: dict,
+        extra_headers: dict
+    ) -> None:
+        self.encoding = encoding
+        self.size = len(body)
+        self.body = body
+        self.etag = etag
+        (
+            self.header_block, self.response_head,
+            self.not_modified_head, self.partial_head
+        ) = _build_heads(
+            content_type, self.size, validators,
+            {'Content-Encoding': encoding, **extra_headers}
+        )
+
+    @property
+    def cost(self) -> int:
+        return (
+            self.size + len(self.header_block) + len(self.response_head)
+            + len(self.not_modified_head) + len(self.partial_head)
+        )
+
+
+class CachedAsset:
+    __slots__ = (
+        'path', 'size', 'content_type', 'body', 'etag', 'last_modified',
+        'header_block', 'response_head', 'not_modified_head', 'partial_head',
+        'variants', 'mtime_ns', 'inode', 'checked_at'
+    )
+
+    def __init__(
+        self,
+        path: str,
+        stat: os.stat_result,
+        body: bytes | None,
+        extra_headers: dict,
+        cache_control: str | None = None
+    ) -> None:
+        self.path = path
+        self.size = stat.st_size
+        self.content_type = (
+            mimetypes.guess_type(path)[0] or DEFAULT_CONTENT_TYPE
+        )
+        self.body = body
+        self.mtime_ns = stat.st_mtime_ns
+        self.inode = stat.st_ino
+        self.checked_at = time.monotonic()
+
+        if body is not None:
+            version = hashlib.blake2b(body, digest_size=12).hexdigest()
+        else:
+            version = f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+        self.etag = f'"{version}"'
+        # Whole seconds, as sent in Last-Modified
+        self.last_modified = int(stat.st_mtime)
+
+        validators = {
+            'ETag': self.etag,
+            'Last-Modified': formatdate(self.last_modified, usegmt=True)
+        }
+        if cache_control is not None:
+            validators['Cache-Control'] = cache_control
+
+        encoded = {}
+        if body is not None:
+            encoded = compress_variants(body, self.content_type)
+        if encoded:
+            validators['Vary'] = 'Accept-Encoding'
+
+        (
+            self.header_block, self.response_head,
+            self.not_modified_head, self.partial_head
+        ) = _build_heads(self.content_type, self.size, validators, extra_headers)
+
+        # Compressed variants in order of preference. Each is a different
+        # representation, so it needs a different strong ETag
+        self.variants = {}
+        for encoding, encoded_body in encoded.items():
+            etag = f'"{version}-{encoding}"'
+            self.variants[encoding] = EncodedVariant(
+                encoding, encoded_body, etag, self.content_type,
+                {**validators, 'ETag': etag}, extra_headers
+            )
+
+    @property
+    def cost(self) -> int:
+        # Bytes this entry holds against the cache budget
+        body_size = len(self.body) if self.body is not None else 0
+        return (
+            body_size + len(self.header_block) + len(self.response_head)
+            + len(self.not_modified_head) + len(self.partial_head)
+            + sum(variant.cost for variant in self.variants.values())
+        )
+
+    def select(self, accept_encoding: str | None) -> 'CachedAsset | EncodedVariant':
+        # Representation to send for the request's Accept-Encoding: the
+        # preferred variant the client accepts, or the asset itself
+        if not self.variants:
+            return self
+        encoding = negotiate(accept_encoding, self.variants)
+        return self.variants[encoding] if encoding is not None else self
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return (
+            self.mtime_ns == stat.st_mtime_ns
+            and self.inode == stat.st_ino
+            and self.size == stat.st_size
+        )
+
+
+class AssetCache:
+    def __init__(
+        self,
+        byte_budget: int = CACHE_BYTE_BUDGET,
+        max_entry_size: int = CACHE_MAX_ENTRY_SIZE,
+        revalidate_interval: float = REVALIDATE_INTERVAL,
+        extra_headers: dict | None = None,
+        cache_control: dict | None = None
+    ) -> None:
+        # cache_control maps glob patterns of file paths to Cache-Control
+        # values, in order of precedence
+        self.byte_budget = byte_budget
+        self.max_entry_size = max_entry_size
+        self.revalidate_interval = revalidate_interval
+        self.extra_headers = extra_headers or {}
+        self.cache_control = cache_control or {}
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, path: str) -> CachedAsset | None:
+        # Returns the asset for a request path, or None if there is no such
+        # file. Directories resolve to their index.html. Entries are keyed
+        # on the normalised path, so spellings of the same path like
+        # //index.html or /./index.html cannot fill the cache with copies
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+
+        now = time.monotonic()
+        if entry is not None and now - entry.checked_at < self.revalidate_interval:
+            return entry
+
+        if entry is not None:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+
+            if stat is not None and entry.matches(stat):
+                entry.checked_at = now
+                return entry
+
+            self.invalidate(path)
+
+        return self._load(path)
+
+    def preload(self, directory: str) -> None:
+        # Loads the directory's index and files ahead of the first request,
+        # so compression happens at startup. Files over the budget are
+        # simply not kept
+        self.lookup(os.path.join(directory, ''))
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.lookup(entry.path)
+
+    def invalidate(self, path: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= entry.cost
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _load(self, path: str) -> CachedAsset | None:
+        file_path = path
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, 'index.html')
+
+        try:
+            with open(file_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if not S_ISREG(stat.st_mode):
+                    return None
+
+                body = None
+                if stat.st_size <= self.max_entry_size:
+                    body = f.read()
+        except OSError:
+            return None
+
+        entry = CachedAsset(
+            file_path, stat, body, self.extra_headers,
+            self._cache_control(file_path)
+        )
+        if entry.cost > self.byte_budget:
+            return entry
+
+        with self.lock:
+            previous = self.entries.pop(path, None)
+            if previous is not None:
+                self.size -= previous.cost
+
+            self.entries[path] = entry
+            self.size += entry.cost
+            self._evict()
+
+        return entry
+
+    def _cache_control(self, path: str) -> str | None:
+        for pattern, policy in self.cache_control.items():
+            if fnmatch.fnmatch(path, pattern):
+                return policy
+        return None
+
+    def _evict(self) -> None:
+        # Drop least recently used entries until back under budget
+        while self.size > self.byte_budget and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.cost
+
+
+def _build_heads(
+    content_type: str,
+    size: int,
+    validators: dict,
+    headers: dict
+) -> tuple[bytes, bytes, bytes, bytes]:
+    # Header block of a full response and the heads built from it: the
+    # status line and headers of a 200, of a 304 which only repeats the
+    # validators and caching policy, and the start of a 206 which the
+    # handler completes with the type, length and range of the part sent.
+    # Each line is CRLF terminated so the handler can append per-response
+    # headers before the blank line
+    representation = {**validators, **headers}
+    header_block = _encode_headers({
+        'Content-Type': content_type,
+        'Content-Length': size,
+        'Accept-Ranges': 'bytes',
+        **representation
+    })
+    return (
+        header_block,
+        STATUS_LINES[200] + header_block,
+        STATUS_LINES[304] + _encode_headers(validators),
+        STATUS_LINES[206] + _encode_headers(representation)
+    )
+
+
+def _encode_headers(headers: dict) -> bytes:
+    return ''.join(f'{k}: {v}\r\n' for k, v in headers.items()).encode()
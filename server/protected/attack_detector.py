@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# Online detection of abusive clients from streaming per-IP statistics.
+# Every counter decays exponentially with a half-life of HALF_LIFE seconds,
+# so each event costs one decay step and a few comparisons no matter how
+# much traffic a client has sent, and no per-event history is kept.
+# Tracked per client:
+# - Connection rate, connections per second over the recent past
+# - Incomplete ratio, connections that ended without a complete request
+#   (what slowloris-style clients look like)
+# - Error ratio, 4xx responses (including 429) out of all responses
+# - Connection duration, a moving average of how long connections stay open
+# A client crossing any threshold is banned through the callback. Each ban
+# doubles the next one up to MAX_BAN_TIME, and the offence count itself
+# halves every OFFENCE_HALF_LIFE seconds, so bans decay for reformed clients.
+# The same statistics give each client a reputation for scheduling:
+# - TRUSTED, has been served TRUSTED_RESPONSES times lately with every
+#   ratio under SUSPECT_FRACTION of its threshold
+# - SUSPECT, past SUSPECT_FRACTION of any threshold, or offended recently
+# - UNKNOWN, anyone else, including new clients
+import math
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+
+HALF_LIFE = 10.0
+MIN_SAMPLES = 10
+MAX_TRACKED_CLIENTS = 100_000
+
+DETECTOR_THRESHOLDS = {
+    'connection_rate': 20.0,
+    'incomplete_ratio': 0.5,
+    'error_ratio': 0.8,
+    'connection_duration': 60.0
+}
+
+BASE_BAN_TIME = 30.0
+MAX_BAN_TIME = 3600.0
+OFFENCE_HALF_LIFE = 3600.0
+
+# Reputation classes, in the order clients are served
+TRUSTED, UNKNOWN, SUSPECT = 0, 1, 2
+TRUSTED_RESPONSES = 3
+SUSPECT_FRACTION = 0.5
+
+
+class _ClientStats:
+    __slots__ = (
+        'updated', 'connections', 'closed', 'incomplete',
+        'responses', 'errors', 'duration', 'offences', 'offended',
+        'banned_until'
+    )
+
+    def __init__(self, now: float) -> None:
+        self.updated = now
+        self.connections = 0.0
+        self.closed = 0.0
+        self.incomplete = 0.0
+        self.responses = 0.0
+        self.errors = 0.0
+        self.duration = 0.0
+        self.offences = 0.0
+        self.offended = now
+        self.banned_until = 0.0
+
+    def decay(self, now: float) -> None:
+        factor = 0.5 ** ((now - self.updated) / HALF_LIFE)
+        self.updated = now
+        self.connections *= factor
+        self.closed *= factor
+        self.incomplete *= factor
+        self.responses *= factor
+        self.errors *= factor
+
+    def reset(self) -> None:
+        self.connections = self.closed = self.incomplete = 0.0
+        self.responses = self.errors = self.duration = 0.0
+
+
+class AttackDetector:
+    def __init__(
+        self,
+        ban: Callable[[str, float, str], None],
+        thresholds: dict | None = None,
+        max_clients: int = MAX_TRACKED_CLIENTS
+    ) -> None:
+        # ban(client, duration, reason) is called when a client is caught
+        self.ban = ban
+        self.thresholds = {**DETECTOR_THRESHOLDS, **(thresholds or {})}
+        self.max_clients = max_clients
+
+        # Decayed counts cover roughly the last HALF_LIFE / ln 2 seconds
+        self.rate_window = HALF_LIFE / math.log(2)
+        self.clients = OrderedDict()
+        self.lock = threading.Lock()
+
+    def record_connection(self, client: str) -> bool:
+        # Returns True if the client was banned by this event
+        with self.lock:
+            stats = self._stats(client)
+            stats.connections += 1
+            rate = stats.connections / self.rate_window
+            if rate > self.thresholds['connection_rate']:
+                return self._offend(client, stats, f'{rate:.1f} connections/s')
+        return False
+
+    def record_response(self, client: str, status_code: int) -> bool:
+        with self.lock:
+            stats = self._stats(client)
+            stats.responses += 1
+            if 400 <= status_code < 500:
+                stats.errors += 1
+
+            if stats.responses >= MIN_SAMPLES:
+                ratio = stats.errors / stats.responses
+                if ratio > self.thresholds['error_ratio']:
+                    return self._offend(client, stats, f'{ratio:.0%} 4xx responses')
+        return False
+
+    def record_close(
+        self,
+        client: str,
+        duration: float,
+        incomplete: bool
+    ) -> bool:
+        # incomplete: the connection ended part way through a request
+        with self.lock:
+            stats = self._stats(client)
+            stats.closed += 1
+            if incomplete:
+                stats.incomplete += 1
+
+            # Moving average weighted like the other decayed counters
+            weight = 1 / max(stats.closed, 1)
+            stats.duration += (duration - stats.duration) * weight
+
+            if stats.closed < MIN_SAMPLES:
+                return False
+
+            ratio = stats.incomplete / stats.closed
+            if ratio > self.thresholds['incomplete_ratio']:
+                return self._offend(
+                    client, stats, f'{ratio:.0%} incomplete requests'
+                )
+            if stats.duration > self.thresholds['connection_duration']:
+                return self._offend(
+                    client, stats, f'{stats.duration:.1f}s average connection'
+                )
+        return False
+
+    def reputation(self, client: str) -> int:
+        # One of TRUSTED, UNKNOWN or SUSPECT
+        with self.lock:
+            stats = self.clients.get(client)
+            if stats is None:
+                return UNKNOWN
+
+            now = time.monotonic()
+            stats.decay(now)
+            offences = stats.offences * 0.5 ** (
+                (now - stats.offended) / OFFENCE_HALF_LIFE
+            )
+            if now < stats.banned_until or offences >= 0.5:
+                return SUSPECT
+
+            # Ratios only count once there are a few samples
+            limits = {
+                name: threshold * SUSPECT_FRACTION
+                for name, threshold in self.thresholds.items()
+            }
+            incomplete_ratio = error_ratio = 0.0
+            if stats.closed >= TRUSTED_RESPONSES:
+                incomplete_ratio = stats.incomplete / stats.closed
+            if stats.responses >= TRUSTED_RESPONSES:
+                error_ratio = stats.errors / stats.responses
+            if (
+                stats.connections / self.rate_window > limits['connection_rate']
+                or incomplete_ratio > limits['incomplete_ratio']
+                or error_ratio > limits['error_ratio']
+                or stats.duration > limits['connection_duration']
+            ):
+                return SUSPECT
+
+            if stats.responses >= TRUSTED_RESPONSES:
+                return TRUSTED
+            return UNKNOWN
+
+    def _stats(self, client: str) -> _ClientStats:
+        now = time.monotonic()
+        stats = self.clients.get(client)
+        if stats is None:
+            stats = self.clients[client] = _ClientStats(now)
+            if len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(client)
+            stats.decay(now)
+        return stats
+
+    def _offend(self, client: str, stats: _ClientStats, reason: str) -> bool:
+        # Bans the client for a period that grows with its recent offences.
+        # Connections that were already open when the ban started do not
+        # extend it as they wind down
+        now = stats.updated
+        if now < stats.banned_until:
+            return True
+
+        stats.offences *= 0.5 ** ((now - stats.offended) / OFFENCE_HALF_LIFE)
+        stats.offended = now
+        duration = min(BASE_BAN_TIME * 2 ** stats.offences, MAX_BAN_TIME)
+        stats.offences += 1
+        stats.banned_until = now + duration
+        stats.reset()
+
+        self.ban(client, duration, reason)
+        return True
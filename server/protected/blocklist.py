@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# IPv4/IPv6 CIDR blocklist checked on every accepted connection.
+# Ranges are stored in a path-compressed binary (radix) trie per address
+# family, so a lookup visits at most one node per stored prefix on the
+# address's path instead of one per bit, and memory stays at about two
+# nodes per range.
+# - Ranges can be loaded from a file, one CIDR or address per line with an
+#   optional TTL in seconds, and '#' comments. Invalid lines are logged
+#   and skipped, and a file that cannot be read keeps the ranges loaded
+# - A background thread checks the file every RELOAD_INTERVAL seconds.
+#   A changed file is parsed into new tries off to the side, which replace
+#   the file's old ones in a single assignment, so lookups never wait on a
+#   reload or see one half done
+# - Ranges can also be added or removed live, in tries of their own
+# - Ranges with a TTL stop matching once it passes. Live ones are pruned
+#   by purge_expired(), the file's go with the next reload
+import os
+import time
+import heapq
+import socket
+import ipaddress
+import itertools
+import threading
+
+from server_logs import log_message
+from threads import start_thread
+
+
+RELOAD_INTERVAL = 1.0
+PERMANENT = float('inf')
+
+
+class _Node:
+    # prefix holds the top `length` bits of the range's address.
+    # expires is None for nodes that only join two branches
+    __slots__ = ('prefix', 'length', 'children', 'expires')
+
+    def __init__(
+        self,
+        prefix: int,
+        length: int,
+        expires: float | None = None
+    ) -> None:
+        self.prefix = prefix
+        self.length = length
+        self.children = [None, None]
+        self.expires = expires
+
+
+class _RadixTrie:
+    def __init__(self, bits: int) -> None:
+        self.bits = bits
+        self.root = _Node(0, 0)
+        self.size = 0
+
+    def insert(self, prefix: int, length: int, expires: float) -> None:
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.expires is None:
+                    self.size += 1
+                node.expires = expires
+                return
+
+            bit = (prefix >> (length - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(prefix, length, expires)
+                self.size += 1
+                return
+
+            common = _common_length(child.prefix, child.length, prefix, length)
+            if common == child.length:
+                node = child
+                continue
+
+            # Split the edge with a node at the common prefix. The new node
+            # is fully built before being linked in, so lock-free readers
+            # never see a partial trie
+            middle = _Node(prefix >> (length - common), common)
+            child_bit = (child.prefix >> (child.length - common - 1)) & 1
+            middle.children[child_bit] = child
+            if common == length:
+                middle.expires = expires
+            else:
+                middle.children[1 - child_bit] = _Node(prefix, length, expires)
+            node.children[bit] = middle
+            self.size += 1
+            return
+
+    def remove(self, prefix: int, length: int) -> bool:
+        path, node = [], self.root
+        while node is not None and node.length < length:
+            if node.length and (prefix >> (length - node.length)) != node.prefix:
+                return False
+            path.append(node)
+            node = node.children[(prefix >> (length - node.length - 1)) & 1]
+
+        if node is None or node.length != length or node.prefix != prefix:
+            return False
+        if node.expires is None:
+            return False
+
+        node.expires = None
+        self.size -= 1
+
+        # Drop the emptied node, then its parent too if that only joined
+        # this node with one other branch
+        while path and node.expires is None:
+            parent = path.pop()
+            remaining = [c for c in node.children if c is not None]
+            if len(remaining) > 1:
+                return True
+            parent.children[parent.children.index(node)] = (
+                remaining[0] if remaining else None
+            )
+            node = parent
+        return True
+
+    def contains(self, address: int, now: float) -> bool:
+        # True if any unexpired range covers the address
+        bits = self.bits
+        node = self.root
+        while node is not None:
+            length = node.length
+            if length and (address >> (bits - length)) != node.prefix:
+                return False
+            if node.expires is not None and node.expires > now:
+                return True
+            if length == bits:
+                return False
+            node = node.children[(address >> (bits - length - 1)) & 1]
+        return False
+
+
+class Blocklist:
+    def __init__(
+        self,
+        path: str | None = None,
+        reload_interval: float = RELOAD_INTERVAL
+    ) -> None:
+        self.path = path
+        self.reload_interval = reload_interval
+        # Ranges added live, and those from the file, replaced on reload
+        self.tries = _new_tries()
+        self.file_tries = _new_tries()
+        self.lock = threading.Lock()
+
+        # (expires, sequence, network) for live ranges with a TTL
+        self.expiry_heap = []
+        self.sequence = itertools.count()
+        self.file_mtime = None
+
+        self.stopped = threading.Event()
+        if path is not None:
+            self.refresh()
+            start_thread(self._reload_periodically, name='blocklist')
+
+    def contains(self, address: str) -> bool:
+        # Called on the accept path, so avoids ipaddress and locking
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, address)
+        except OSError:
+            return False
+
+        address = int.from_bytes(packed, 'big')
+        now = time.monotonic()
+        for trie in (self.tries[family], self.file_tries[family]):
+            if trie.size and trie.contains(address, now):
+                return True
+        return False
+
+    def add(self, network: str, ttl: float | None = None) -> None:
+        # Blocks a CIDR range or single address, for ttl seconds if given
+        network = ipaddress.ip_network(network, strict=False)
+        expires = PERMANENT if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            _insert(self.tries, network, expires)
+            if ttl is not None:
+                heapq.heappush(
+                    self.expiry_heap, (expires, next(self.sequence), network)
+                )
+
+    def remove(self, network: str) -> bool:
+        # Only ranges added live, the file's last until it changes
+        network = ipaddress.ip_network(network, strict=False)
+        with self.lock:
+            return self._remove(network)
+
+    def purge_expired(self) -> int:
+        # Removes ranges whose TTL has passed, returns how many
+        now = time.monotonic()
+        purged = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                expires, _, network = heapq.heappop(self.expiry_heap)
+                if self._expires(network) == expires:
+                    purged += self._remove(network)
+        return purged
+
+    def refresh(self) -> None:
+        # Reloads the file if it changed and purges expired live ranges.
+        # Run by the reload thread, never on the accept path
+        if self.path is None:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        # Retried on the next refresh if the file could not be read
+        if mtime != self.file_mtime and self._load_file(mtime is not None):
+            self.file_mtime = mtime
+
+        self.purge_expired()
+
+    def close(self) -> None:
+        # Stops the reload thread
+        self.stopped.set()
+
+    def __len__(self) -> int:
+        return sum(
+            trie.size
+            for tries in (self.tries, self.file_tries)
+            for trie in tries.values()
+        )
+
+    def _reload_periodically(self) -> None:
+        while not self.stopped.wait(self.reload_interval):
+            self.refresh()
+
+    def _load_file(self, exists: bool) -> bool:
+        # Replaces the file's ranges with its current contents, or removes
+        # them if it no longer exists. Returns False, leaving the ranges as
+        # they were, if it could not be read
+        entries = []
+        if exists:
+            try:
+                with open(self.path) as f:
+                    lines = f.readlines()
+            except (OSError, UnicodeDecodeError) as error:
+                log_message(f'Could not reload blocklist {self.path}: {error}')
+                return False
+
+            for number, line in enumerate(lines, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    entries.append(_parse_entry(fields))
+                except ValueError as error:
+                    log_message(
+                        f'Skipping line {number} of blocklist {self.path}: {error}'
+                    )
+
+        # Built while lookups use the old tries, then swapped in at once
+        tries = _new_tries()
+        now = time.monotonic()
+        for network, ttl in entries:
+            _insert(tries, network, PERMANENT if ttl is None else now + ttl)
+        self.file_tries = tries
+        return True
+
+    def _expires(self, network) -> float | None:
+        trie = self.tries[_family(network)]
+        prefix = _prefix(network)
+        node = trie.root
+        while node is not None and node.length < network.prefixlen:
+            node = node.children[(prefix >> (network.prefixlen - node.length - 1)) & 1]
+        if node is None or node.length != network.prefixlen or node.prefix != prefix:
+            return None
+        return node.expires
+
+    def _remove(self, network) -> bool:
+        return self.tries[_family(network)].remove(
+            _prefix(network), network.prefixlen
+        )
+
+
+def _new_tries() -> dict:
+    return {
+        socket.AF_INET: _RadixTrie(32),
+        socket.AF_INET6: _RadixTrie(128)
+    }
+
+
+def _insert(tries: dict, network, expires: float) -> None:
+    tries[_family(network)].insert(_prefix(network), network.prefixlen, expires)
+
+
+def _family(network) -> int:
+    return socket.AF_INET if network.version == 4 else socket.AF_INET6
+
+
+def _prefix(network) -> int:
+    # The network address's top prefixlen bits
+    return int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+
+
+def _parse_entry(fields: list[str]) -> tuple:
+    # CIDR or address, and an optional TTL in seconds
+    network = ipaddress.ip_network(fields[0], strict=False)
+    ttl = None
+    if len(fields) > 1:
+        ttl = float(fields[1])
+        # Also rejects NaN
+        if not ttl >= 0:
+            raise ValueError(f'invalid TTL {fields[1]!r}')
+    return network, ttl
+
+
+def _common_length(a: int, a_length: int, b: int, b_length: int) -> int:
+    # Number of leading bits two prefixes share
+    length = min(a_length, b_length)
+    difference = (a >> (a_length - length)) ^ (b >> (b_length - length))
+    return length - difference.bit_length()
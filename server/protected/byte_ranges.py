@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Byte range requests, for clients resuming or seeking in large assets.
+# - parse_range() turns a Range header into sorted (start, end) pairs,
+#   with end inclusive as in Content-Range. Overlapping and adjacent ranges
+#   are merged, and a header asking for more than MAX_RANGES ranges is
+#   ignored so the whole file is sent once (many small overlapping ranges
+#   are a known way to make a server do far more work than the client)
+# - A single range is sent as it is, several as multipart/byteranges.
+#   multipart_parts() gives the head of each part, which the handler
+#   follows with that part's bytes, and the closing delimiter
+# Bodies are never sliced here, the handler sends each part from the
+# cached body through a memoryview or from the file with sendfile
+import secrets
+
+
+MAX_RANGES = 16
+# One boundary per process. It is random, so it cannot collide with the
+# contents of the parts
+MULTIPART_BOUNDARY = secrets.token_hex(16)
+MULTIPART_CONTENT_TYPE = f'multipart/byteranges; boundary={MULTIPART_BOUNDARY}'
+
+
+def parse_range(header: str, size: int) -> list[tuple[int, int]] | None:
+    # Satisfiable ranges of a representation of size bytes. None means the
+    # header is to be ignored (invalid, not in bytes or too many ranges),
+    # an empty list that no range is satisfiable and the answer is 416
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        if not dash or not (first or last):
+            return None
+        if not all(value.isdecimal() for value in (first, last) if value):
+            return None
+
+        if not first:
+            # Suffix range, the last bytes of the representation
+            suffix = int(last)
+            if suffix and size:
+                ranges.append((max(size - suffix, 0), size - 1))
+            continue
+
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            end = min(int(last), size - 1) if last else size - 1
+            ranges.append((start, end))
+
+    return _merge(ranges)
+
+
+def content_range(start: int, end: int, size: int) -> str:
+    return f'bytes {start}-{end}/{size}'
+
+
+def multipart_parts(
+    ranges: list[tuple[int, int]],
+    content_type: str,
+    size: int
+) -> tuple[list[tuple[bytes, int, int]], bytes, int]:
+    # (part head, offset, count) for each range, the closing delimiter and
+    # the total length of the multipart body
+    parts = []
+    length = 0
+    for start, end in ranges:
+        head = (
+            f'\r\n--{MULTIPART_BOUNDARY}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: {content_range(start, end, size)}\r\n'
+            '\r\n'
+        ).encode()
+        count = end - start + 1
+        parts.append((head, start, count))
+        length += len(head) + count
+
+    closing = f'\r\n--{MULTIPART_BOUNDARY}--\r\n'.encode()
+    return parts, closing, length + len(closing)
+
+
+def _merge(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Precompressed variants of static assets and Accept-Encoding negotiation.
+# Compressible assets are compressed once per version when the asset cache
+# loads them, at the highest level since the cost is not paid per request.
+# Only variants smaller than the original are kept.
+# Brotli is used when the brotli package is installed, gzip always
+import gzip
+from functools import lru_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MIN_COMPRESS_SIZE = 256
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml'
+)
+
+# Encoders by content coding, in order of preference
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS['br'] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+ENCODERS['gzip'] = lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+
+def compress_variants(body: bytes, content_type: str) -> dict[str, bytes]:
+    # Compressed bodies by content coding, in order of preference
+    if len(body) < MIN_COMPRESS_SIZE or not content_type.startswith(COMPRESSIBLE_TYPES):
+        return {}
+
+    variants = {}
+    for encoding, encode in ENCODERS.items():
+        compressed = encode(body)
+        if len(compressed) < len(body):
+            variants[encoding] = compressed
+    return variants
+
+
+def negotiate(accept_encoding: str | None, available) -> str | None:
+    # The preferred available coding the client accepts, or None for the
+    # original. available must be in order of preference
+    if not accept_encoding:
+        return None
+
+    accepted = _parse_accept_encoding(accept_encoding)
+    for encoding in available:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+@lru_cache(maxsize=256)
+def _parse_accept_encoding(accept_encoding: str) -> dict[str, float]:
+    # Clients send few distinct headers, so parsing is cached.
+    # Codings map to their q-value, malformed q-values count as 0
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip()
+        if not coding:
+            continue
+
+        quality = 1.0
+        name, _, value = params.partition('=')
+        if name.strip() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    return accepted
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Adaptive limit on concurrent connections (AIMD).
+# Instead of a guessed constant the server finds its own limit from the
+# latency of the requests it serves:
+# - The limit starts at the ceiling it was given and is only brought down
+#   by evidence of congestion. Starting low would leave it there while a
+#   few slow clients (slowloris) hold every slot, since it only moves when
+#   requests complete
+# - The baseline is the lowest latency seen lately, which drifts up slowly
+#   so it follows the real cost of a request (about PROCESS_TIME here)
+# - While the smoothed latency stays within LATENCY_TOLERANCE times the
+#   baseline and the limit is actually being used, it grows by about one
+#   connection per limit's worth of requests (additive increase)
+# - When the smoothed latency or error rate climbs past its threshold, the
+#   limit is cut by BACKOFF_RATIO (multiplicative decrease), at most once
+#   per baseline latency so one slow batch only counts once
+# The limit always stays between MIN_LIMIT and the ceiling it was given
+import time
+import threading
+
+
+MIN_LIMIT = 1
+MAX_LIMIT = 1000
+
+LATENCY_TOLERANCE = 1.5
+ERROR_RATE_THRESHOLD = 0.1
+BACKOFF_RATIO = 0.8
+
+# Weight of the newest sample in the smoothed latency and error rate, and
+# how fast the baseline drifts up towards higher latencies
+SMOOTHING = 0.2
+BASELINE_DRIFT = 0.01
+
+
+class AdaptiveLimit:
+    def __init__(
+        self,
+        max_limit: int = MAX_LIMIT,
+        initial_limit: int | None = None,
+        min_limit: int = MIN_LIMIT
+    ) -> None:
+        # The limit starts at max_limit unless given an initial limit
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        if initial_limit is None:
+            initial_limit = max_limit
+        self.limit = float(max(min(initial_limit, max_limit), min_limit))
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        self.baseline = None
+        self.latency = None
+        self.error_rate = 0.0
+        self.next_decrease = 0.0
+
+    def try_acquire(self, share: float = 1.0) -> bool:
+        # Takes a slot if the current limit allows another connection.
+        # With a share, only while fewer than that fraction of it are in use
+        with self.lock:
+            if self.in_flight >= int(self.limit * share):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+    def record(self, latency: float, failed: bool = False) -> float | None:
+        # Feeds one request's latency and outcome. Returns the new limit
+        # if it was cut, so the caller can report it
+        now = time.monotonic()
+        with self.lock:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * BASELINE_DRIFT
+
+            if self.latency is None:
+                self.latency = latency
+            self.latency += (latency - self.latency) * SMOOTHING
+            self.error_rate += (failed - self.error_rate) * SMOOTHING
+
+            congested = (
+                self.latency > self.baseline * LATENCY_TOLERANCE
+                or self.error_rate > ERROR_RATE_THRESHOLD
+            )
+            if congested:
+                if now < self.next_decrease:
+                    return None
+                self.next_decrease = now + self.baseline
+                previous = int(self.limit)
+                self.limit = max(self.limit * BACKOFF_RATIO, self.min_limit)
+                return self.limit if int(self.limit) < previous else None
+
+            # Only grow while the limit is what holds connections back
+            if self.in_flight >= self.limit / 2:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            return None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'baseline': self.baseline,
+                'latency': self.latency,
+                'error_rate': self.error_rate
+            }
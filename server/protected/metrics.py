@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# Live server metrics, exposed in the Prometheus text format on a separate
+# local port so saturation can be watched during an attack.
+# Recording never takes a lock:
+# - Counters and histograms keep one shard per thread, which only that
+#   thread writes. Shards of finished threads are folded into a retired
+#   total, so a thread per connection does not pile them up
+# - Latency histograms are HDR-style: exact below SUB_BUCKETS
+#   microseconds, then SUB_BUCKETS / 2 buckets per power of two, so every
+#   value is kept within about 6% whatever its magnitude
+# - Gauges, and counters kept by the server's own state, are read from
+#   that state when scraped
+# Reads merge the shards, and only happen on a scrape
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from threads import start_thread
+
+
+METRICS_PREFIX = 'dos_server'
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS // 2
+# Latencies are recorded in microseconds, up to 2^36 (about 19 hours)
+MAX_VALUE_BITS = 36
+NUM_BUCKETS = (MAX_VALUE_BITS - SUB_BUCKET_BITS + 2) * HALF_BUCKETS
+QUANTILES = (0.5, 0.99, 0.999)
+
+
+class _ShardOwner:
+    # Held only by the owning thread's local storage, so it is collected
+    # when the thread ends
+    __slots__ = ('values', '__weakref__')
+
+    def __init__(self, values: list) -> None:
+        self.values = values
+
+
+class _ThreadShards:
+    # Per-thread lists of size numbers, summed element-wise on read
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.local = threading.local()
+        self.live = {}
+        self.retired = [0] * size
+        self.lock = threading.Lock()
+
+    def shard(self) -> list:
+        # The calling thread's own list, for it to update in place
+        try:
+            return self.local.owner.values
+        except AttributeError:
+            return self._add_shard()
+
+    def snapshot(self) -> list:
+        with self.lock:
+            total = list(self.retired)
+            for values in self.live.values():
+                for index, value in enumerate(values):
+                    total[index] += value
+        return total
+
+    def _add_shard(self) -> list:
+        owner = _ShardOwner([0] * self.size)
+        with self.lock:
+            self.live[id(owner.values)] = owner.values
+        weakref.finalize(owner, self._retire, owner.values)
+        self.local.owner = owner
+        return owner.values
+
+    def _retire(self, values: list) -> None:
+        with self.lock:
+            self.live.pop(id(values), None)
+            for index, value in enumerate(values):
+                self.retired[index] += value
+
+
+class Counter:
+    def __init__(self) -> None:
+        self.shards = _ThreadShards(1)
+
+    def inc(self, amount: int = 1) -> None:
+        self.shards.shard()[0] += amount
+
+    @property
+    def value(self) -> int:
+        return self.shards.snapshot()[0]
+
+
+class LatencyHistogram:
+    def __init__(self) -> None:
+        # Bucket counts, then the sum of the values and their count
+        self.shards = _ThreadShards(NUM_BUCKETS + 2)
+
+    def record(self, seconds: float) -> None:
+        value = max(int(seconds * 1_000_000), 0)
+        shard = self.shards.shard()
+        shard[_bucket(value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def summary(self, quantiles=QUANTILES) -> tuple[list[float], float, int]:
+        # Values at the quantiles, sum and count, all in seconds
+        values = self.shards.snapshot()
+        buckets, total, count = values[:-2], values[-2], values[-1]
+
+        results = []
+        for quantile in quantiles:
+            rank = quantile * count
+            seen = 0
+            for index, bucket_count in enumerate(buckets):
+                seen += bucket_count
+                if bucket_count and seen >= rank:
+                    results.append(_bucket_upper(index) / 1_000_000)
+                    break
+            else:
+                results.append(0.0)
+        return results, total / 1_000_000, count
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = METRICS_PREFIX) -> None:
+        # name: (type, help, [(labels, metric or read function)])
+        self.prefix = prefix
+        self.families = {}
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        counter = Counter()
+        self._add(name, 'counter', help, labels, counter)
+        return counter
+
+    def counter_function(
+        self, name: str, help: str, read: Callable[[], int], **labels
+    ) -> None:
+        # For totals some other object already counts, read must never decrease
+        self._add(name, 'counter', help, labels, read)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float], **labels) -> None:
+        self._add(name, 'gauge', help, labels, read)
+
+    def histogram(self, name: str, help: str, **labels) -> LatencyHistogram:
+        # Exposed as a summary of QUANTILES
+        histogram = LatencyHistogram()
+        self._add(name, 'summary', help, labels, histogram)
+        return histogram
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, series) in self.families.items():
+            name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, metric in series:
+                if kind == 'counter':
+                    value = metric() if callable(metric) else metric.value
+                    lines.append(f'{name}{_labels(labels)} {value}')
+                elif kind == 'gauge':
+                    lines.append(f'{name}{_labels(labels)} {metric()}')
+                else:
+                    values, total, count = metric.summary()
+                    for quantile, value in zip(QUANTILES, values):
+                        lines.append(
+                            f'{name}{_labels({**labels, "quantile": quantile})} {value}'
+                        )
+                    lines.append(f'{name}_sum{_labels(labels)} {total}')
+                    lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, name: str, kind: str, help: str, labels: dict, metric) -> None:
+        family = self.families.setdefault(name, (kind, help, []))
+        family[2].append((labels, metric))
+
+
+class MetricsServer(ThreadingHTTPServer):
+    # Serves the registry at /metrics from a daemon thread
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], registry: MetricsRegistry) -> None:
+        super().__init__(address, _MetricsHandler)
+        self.registry = registry
+        self.thread = start_thread(self.serve_forever, name='metrics')
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # Scrapes are not logged
+        pass
+
+
+def _bucket(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return min(shift * HALF_BUCKETS + (value >> shift), NUM_BUCKETS - 1)
+
+
+def _bucket_upper(index: int) -> int:
+    # Highest value counted in a bucket
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // HALF_BUCKETS - 1
+    return ((index - shift * HALF_BUCKETS + 1) << shift) - 1
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Instrumentation for finding where the time goes when throughput collapses.
+# - Phase timing (opt-in): each connection carries a PhaseTimer that adds
+#   the perf_counter_ns time since its last mark to the phase just ended.
+#   A request's phases are recorded into per-phase histograms when it
+#   finishes, and the histograms are exposed with the server's metrics.
+#   When timing is off every connection shares NULL_TIMER, which does nothing
+# - Sampling profiler: a signal starts it and the next one stops it. While
+#   running, a thread samples the stacks of every other thread every
+#   SAMPLE_INTERVAL seconds. On stop the stacks are written in the folded
+#   format (one 'frame;frame;... count' line per distinct stack, split on
+#   the last space) that flamegraph.pl and speedscope read
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+from metrics import MetricsRegistry
+from server_logs import log_message
+from threads import start_thread
+
+
+# In the order a connection goes through them. Reading is waiting for and
+# receiving the request, parsing is the parser's own work on it. Head and
+# body are composed into a buffer, and the buffer goes out in send
+PHASES = (
+    'accept', 'queue_wait', 'read', 'parse', 'processing',
+    'resolve', 'head', 'body', 'send', 'close'
+)
+SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = 'profiles'
+
+
+class PhaseTimer:
+    __slots__ = ('histograms', 'mark', 'elapsed')
+
+    def __init__(self, histograms: dict) -> None:
+        self.histograms = histograms
+        self.mark = time.perf_counter_ns()
+        self.elapsed = {}
+
+    def lap(self, phase: str) -> None:
+        # The time since the last mark was spent in phase
+        now = time.perf_counter_ns()
+        self.elapsed[phase] = self.elapsed.get(phase, 0) + now - self.mark
+        self.mark = now
+
+    def finish(self) -> None:
+        # Records the phases of the request that just ended
+        for phase, elapsed in self.elapsed.items():
+            self.histograms[phase].record(elapsed / 1e9)
+        self.elapsed.clear()
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def lap(self, phase: str) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class PhaseTimings:
+    def __init__(self, registry: MetricsRegistry, enabled: bool) -> None:
+        self.enabled = enabled
+        self.histograms = {
+            phase: registry.histogram(
+                'phase_seconds', 'Time spent in each phase of a request',
+                phase=phase
+            )
+            for phase in PHASES
+        } if enabled else {}
+
+    def timer(self) -> PhaseTimer | _NullTimer:
+        # A timer starting now, for a newly accepted connection
+        return PhaseTimer(self.histograms) if self.enabled else NULL_TIMER
+
+    def report(self) -> list[str]:
+        # One line per phase with its p50/p99/p999 in milliseconds
+        lines = []
+        for phase, histogram in self.histograms.items():
+            values, total, count = histogram.summary()
+            if count:
+                lines.append(
+                    f'{phase:<11} n={count:<8} total={total:.3f}s '
+                    + ' '.join(f'{value * 1000:.3f}' for value in values)
+                    + ' ms (p50 p99 p999)'
+                )
+        return lines
+
+
+class SamplingProfiler:
+    def __init__(
+        self,
+        directory: str = PROFILE_DIR,
+        interval: float = SAMPLE_INTERVAL
+    ) -> None:
+        self.directory = directory
+        self.interval = interval
+        self.stop_event = None
+
+    def toggle(self, signum=None, frame=None) -> None:
+        # Usable as the signal handler. Stopping only signals the sampling
+        # thread, which writes the profile itself
+        if self.stop_event is None:
+            self.stop_event = threading.Event()
+            start_thread(self._sample, self.stop_event, name='profiler')
+        else:
+            self.stop_event.set()
+            self.stop_event = None
+
+    def _sample(self, stop_event: threading.Event) -> None:
+        stacks = Counter()
+        own_id = threading.get_ident()
+        started = time.time()
+        samples = 0
+
+        while not stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stacks[_fold(names.get(thread_id, 'thread'), frame)] += 1
+            samples += 1
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f'profile-{os.getpid()}-{int(started)}.folded'
+        )
+        with open(path, 'w') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in stacks.items())
+
+        log_message(f'Profile of {samples} samples written to {path}')
+
+
+def _fold(thread_name: str, frame) -> str:
+    # Root first, each frame as function (file:line of its definition)
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(
+            f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        )
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ';'.join(reversed(frames))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Per-client rate limiting keyed by IP address.
+# Uses the generic cell rate algorithm (GCRA), which behaves like a token
+# bucket holding `limit` tokens refilled over `window` seconds but only
+# stores one timestamp per client: the theoretical arrival time (TAT) of
+# the client's next request. Checks and updates are O(1).
+# Clients whose TAT has passed are indistinguishable from new clients, so
+# their entries are expired lazily, and the table never grows past
+# max_clients entries
+# Banned clients are kept in a separate table until their ban runs out.
+# SharedClientTable in shared_state.py offers the same interface for state
+# shared between worker processes
+import time
+import threading
+from collections import OrderedDict
+
+
+MAX_TRACKED_CLIENTS = 100_000
+
+# Idle entries checked for expiry on each call
+EXPIRE_BATCH = 4
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        max_clients: int = MAX_TRACKED_CLIENTS
+    ) -> None:
+        # Allows a burst of `limit` requests, then one request
+        # every window / limit seconds
+        self.emission_interval = window / limit
+        self.burst_tolerance = window - self.emission_interval
+        self.max_clients = max_clients
+
+        # Client -> TAT, ordered from least to most recently updated
+        self.clients = OrderedDict()
+        # Client -> time the ban ends
+        self.banned = {}
+        self.lock = threading.Lock()
+
+    def allow(self, client: str, now: float | None = None) -> bool:
+        # Returns True and records the request if the client is within
+        # its limit, otherwise returns False without charging it
+        if now is None:
+            now = time.monotonic()
+
+        with self.lock:
+            tat = max(self.clients.get(client, now), now)
+            if tat - now > self.burst_tolerance:
+                return False
+
+            self.clients[client] = tat + self.emission_interval
+            self.clients.move_to_end(client)
+            self._expire(now)
+            return True
+
+    def ban(self, client: str, duration: float) -> None:
+        now = time.monotonic()
+        with self.lock:
+            until = max(self.banned.get(client, now), now + duration)
+            self.banned[client] = until
+            if len(self.banned) > self.max_clients:
+                self.banned = {
+                    c: t for c, t in self.banned.items() if t > now
+                }
+
+    def is_banned(self, client: str) -> bool:
+        until = self.banned.get(client)
+        if until is None:
+            return False
+        if until > time.monotonic():
+            return True
+
+        with self.lock:
+            if self.banned.get(client) == until:
+                del self.banned[client]
+        return False
+
+    def _expire(self, now: float) -> None:
+        # Drops a few of the least recently updated entries once their TAT
+        # has passed, and the oldest entries if over the size bound
+        for _ in range(EXPIRE_BATCH):
+            client, tat = next(iter(self.clients.items()))
+            if tat > now:
+                break
+            del self.clients[client]
+
+        while len(self.clients) > self.max_clients:
+            self.clients.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.clients)
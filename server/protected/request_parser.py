@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Incremental HTTP request header parser fed from raw recv() chunks.
+# Unlike reading lines from a socket file, where a timeout only limits the
+# gap between bytes, the parser bounds the whole request head:
+# - HEADER_DEADLINE, total seconds allowed from the first byte to the
+#   blank line ending the headers
+# - MIN_DATA_RATE, bytes per second the client must keep up once the
+#   first MIN_RATE_GRACE seconds have passed
+# - MAX_HEADER_COUNT and MAX_HEADER_SIZE, checked as data arrives so an
+#   oversized head is refused before it is buffered
+# A client dripping one header every few seconds (slowloris) is therefore
+# dropped in bounded time, and every connection holds bounded memory.
+# Bytes after a complete head stay buffered for the next (pipelined) request
+from http import HTTPStatus
+
+
+HEADER_DEADLINE = 10.0
+MIN_DATA_RATE = 50
+MIN_RATE_GRACE = 2.0
+MAX_HEADER_COUNT = 100
+MAX_HEADER_SIZE = 8192
+
+
+class RequestError(Exception):
+    # The request can't be served, status_code is the error to reply with
+    def __init__(self, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ParsedRequest:
+    __slots__ = ('command', 'path', 'version', 'headers')
+
+    def __init__(
+        self,
+        command: str,
+        path: str,
+        version: str,
+        headers: dict
+    ) -> None:
+        # Header names are lowercase
+        self.command = command
+        self.path = path
+        self.version = version
+        self.headers = headers
+
+
+class RequestParser:
+    def __init__(
+        self,
+        header_deadline: float = HEADER_DEADLINE,
+        min_data_rate: float = MIN_DATA_RATE,
+        max_header_count: int = MAX_HEADER_COUNT,
+        max_header_size: int = MAX_HEADER_SIZE
+    ) -> None:
+        self.header_deadline = header_deadline
+        self.min_data_rate = min_data_rate
+        self.max_header_count = max_header_count
+        self.max_header_size = max_header_size
+
+        self.buffer = bytearray()
+        # Time the first byte of the current request arrived, and how much
+        # of the buffer has already been searched for the end of the head
+        self.started = None
+        self.scanned = 0
+        self.lines = 0
+
+    @property
+    def pending(self) -> bool:
+        # Part of a request has arrived but not all of its head
+        return bool(self.buffer)
+
+    def feed(self, data: bytes, now: float) -> None:
+        if not self.buffer:
+            self.started = now
+        self.buffer += data
+
+    def deadline(self) -> float:
+        # Monotonic time by which the current head must be complete, the
+        # earlier of the total deadline and the minimum data rate running out
+        rate_deadline = (
+            self.started + MIN_RATE_GRACE
+            + len(self.buffer) / self.min_data_rate
+        )
+        return min(self.started + self.header_deadline, rate_deadline)
+
+    def expired(self, now: float) -> RequestError:
+        return RequestError(
+            HTTPStatus.REQUEST_TIMEOUT,
+            f'Request headers incomplete after {now - self.started:.1f}s'
+        )
+
+    def next_request(self, now: float) -> ParsedRequest | None:
+        # Returns the next complete request, or None if its head has not
+        # fully arrived yet. Call after every feed so limits apply promptly
+        end, terminator = self._find_head_end()
+        if end < 0:
+            if len(self.buffer) > self.max_header_size:
+                raise self._too_large(f'larger than {self.max_header_size} bytes')
+            if self.lines > self.max_header_count + 1:
+                raise self._too_large(f'more than {self.max_header_count} headers')
+            return None
+
+        if end > self.max_header_size:
+            raise self._too_large(f'larger than {self.max_header_size} bytes')
+
+        head = bytes(self.buffer[:end])
+        del self.buffer[:end + len(terminator)]
+        self.started = now
+        self.scanned = 0
+        self.lines = 0
+
+        # Lines end at LF, after an optional CR. str.splitlines() would also
+        # split header values at bytes like 0x85 (NEL in latin-1), found in
+        # UTF-8 text, or the 0x1c-0x1e separators
+        lines = [
+            line.removesuffix(b'\r').decode('latin-1')
+            for line in head.split(b'\n')
+        ]
+        if len(lines) > self.max_header_count + 1:
+            raise self._too_large(f'more than {self.max_header_count} headers')
+
+        components = lines[0].split(' ') if lines else []
+        if len(components) < 3:
+            raise RequestError(HTTPStatus.BAD_REQUEST, 'Invalid HTTP request line')
+        command, path, version, *_ = components
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if not separator or not name.strip():
+                raise RequestError(HTTPStatus.BAD_REQUEST, 'Invalid header line')
+            headers[name.strip().lower()] = value.strip()
+
+        return ParsedRequest(command, path, version, headers)
+
+    def _find_head_end(self) -> tuple[int, bytes]:
+        # Only searches bytes that arrived since the last call, backing up
+        # far enough to catch a terminator split across chunks, and counts
+        # the header lines among them
+        start = max(self.scanned - 3, 0)
+        self.lines += self.buffer.count(b'\n', self.scanned)
+        self.scanned = len(self.buffer)
+        ends = [
+            (index, terminator)
+            for terminator in (b'\r\n\r\n', b'\n\n')
+            if (index := self.buffer.find(terminator, start)) >= 0
+        ]
+        return min(ends, default=(-1, b''))
+
+    def _too_large(self, reason: str) -> RequestError:
+        return RequestError(
+            HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+            f'Request headers {reason}'
+        )
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Response bytes built once and reused, so the hot paths only pick a
+# prebuilt buffer instead of formatting and encoding headers:
+# - STATUS_LINES, the status line of every known status code
+# - Full bodiless error responses, with either connection behaviour
+# - The Connection headers (and blank line) that end every response head
+# Cached assets add their own status line and entity headers once per
+# file, see CachedAsset.response_head
+from http import HTTPStatus
+
+
+STATUS_LINES = {
+    status.value: f'HTTP/1.1 {status.value} {status.phrase} \r\n'.encode()
+    for status in HTTPStatus
+}
+
+
+def build_response(
+    status_code: int,
+    headers: dict | None = None,
+    close: bool = True
+) -> bytes:
+    # Complete bodiless response. Only meant to be called when building
+    # templates, at startup
+    headers = {
+        'Content-Type': 'text/html',
+        'Content-Length': 0,
+        **(headers or {})
+    }
+    if close:
+        headers['Connection'] = 'close'
+    head = ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+    return STATUS_LINES[status_code] + head.encode() + b'\r\n'
+
+
+class ResponseTemplates:
+    def __init__(self, keepalive_timeout: float, max_keepalive_requests: int) -> None:
+        self.connection_close = b'Connection: close\r\n\r\n'
+        self.connection_keep_alive = (
+            'Connection: keep-alive\r\n'
+            f'Keep-Alive: timeout={keepalive_timeout}, max={max_keepalive_requests}\r\n'
+            '\r\n'
+        ).encode()
+
+        # Error responses for every 4xx and 5xx status, keyed by
+        # (status, close)
+        keep_alive = {'Connection': 'keep-alive', 'Keep-Alive': (
+            f'timeout={keepalive_timeout}, max={max_keepalive_requests}'
+        )}
+        self.errors = {}
+        for status_code in STATUS_LINES:
+            if status_code >= 400:
+                self.errors[status_code, True] = build_response(status_code)
+                self.errors[status_code, False] = build_response(
+                    status_code, keep_alive, close=False
+                )
+
+    def connection(self, close: bool) -> bytes:
+        # Headers ending a response head, including the blank line
+        return self.connection_close if close else self.connection_keep_alive
+
+    def error(self, status_code: int, close: bool = True) -> bytes:
+        return self.errors[status_code, close]
@@ -1,29 +1,170 @@
 #!/usr/bin/env python3
 # Code to write server logs to a file.
 # Written by Jason Phua (z5592964)
+# Logging is asynchronous so request handling never waits on it:
+# - log_message() only appends the record to an in-memory queue
+# - A writer thread takes everything queued every FLUSH_INTERVAL seconds
+#   (sooner once BATCH_SIZE records wait) and writes the batch with one
+#   write to the log file and one to the console
+# - Past SAMPLE_THRESHOLD of LOG_QUEUE_SIZE, only one in SAMPLE_RATE records
+#   is kept, and a full queue drops records. Both are counted, reported in
+#   the log by the writer and kept in log_stats()
+# Console colours are only used on a terminal, and never with NO_COLOR set.
+# Forked children start their own queue and writer, and must call
+# shutdown_logging() before os._exit so their last records are written
 import os
-import logging
+import sys
+import time
+import atexit
+import threading
+from collections import deque
+
+from threads import start_thread
 
 
 LOG_FILE = 'server_log.txt'
 RESET = '\033[0m'
 
+LOG_TO_CONSOLE = True
+LOG_COLOUR = sys.stdout.isatty() and 'NO_COLOR' not in os.environ
+
+LOG_QUEUE_SIZE = 10000
+SAMPLE_THRESHOLD = 0.75
+SAMPLE_RATE = 10
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 0.1
+
+
+class _LogPipeline:
+    def __init__(self) -> None:
+        # (timestamp, message, colour). Appending to a deque is atomic, so
+        # producers take no lock
+        self.records = deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.sample_from = int(LOG_QUEUE_SIZE * SAMPLE_THRESHOLD)
+
+        # Producers count without a lock, so an increment may be lost
+        # under contention and the counts are approximate
+        self.offered = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.written = 0
+        self.reported_dropped = 0
+        self.reported_sampled_out = 0
+
+        self.writer = start_thread(self._run, name='log-writer')
+
+    def put(self, message: str, colour: str) -> None:
+        self.offered += 1
+        depth = len(self.records)
+        if depth >= LOG_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        if depth >= self.sample_from and self.offered % SAMPLE_RATE:
+            self.sampled_out += 1
+            return
+
+        self.records.append((time.time(), message, colour))
+        if depth + 1 >= BATCH_SIZE:
+            self.wakeup.set()
+
+    def stop(self) -> None:
+        self.stopping = True
+        self.wakeup.set()
+        self.writer.join()
+
+    def stats(self) -> dict:
+        return {
+            'queued': len(self.records),
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out
+        }
+
+    def _run(self) -> None:
+        with open(LOG_FILE, 'a') as log_file:
+            while True:
+                self.wakeup.wait(FLUSH_INTERVAL)
+                self.wakeup.clear()
+                self._write_batch(log_file)
+                if self.stopping:
+                    # Records queued while stopping are still written
+                    self._write_batch(log_file)
+                    return
+
+    def _write_batch(self, log_file) -> None:
+        batch = []
+        while self.records:
+            batch.append(self.records.popleft())
+        self._report_losses(batch)
+        if not batch:
+            return
 
-# If log file does not exist, create it
-if not os.path.exists(LOG_FILE):
-    with open(LOG_FILE, 'w') as f:
-        pass
+        lines = []
+        console = []
+        second, stamp = None, ''
+        for timestamp, message, colour in batch:
+            # Same layout as logging's '%(asctime)s - %(message)s'
+            if int(timestamp) != second:
+                second = int(timestamp)
+                stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            lines.append(f'{stamp},{int(timestamp % 1 * 1000):03d} - {message}\n')
+            if LOG_COLOUR:
+                console.append(f'{colour}{message}{RESET}\n')
+            else:
+                console.append(f'{message}\n')
 
-logging.basicConfig(
-    filename='server_log.txt',
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s'
-)
+        log_file.write(''.join(lines))
+        log_file.flush()
+        if LOG_TO_CONSOLE:
+            sys.stdout.write(''.join(console))
+            sys.stdout.flush()
+        self.written += len(batch)
+
+    def _report_losses(self, batch: list) -> None:
+        # Adds a record of the messages lost since the last report
+        dropped = self.dropped - self.reported_dropped
+        sampled_out = self.sampled_out - self.reported_sampled_out
+        if not (dropped or sampled_out):
+            return
+
+        self.reported_dropped += dropped
+        self.reported_sampled_out += sampled_out
+        batch.append((
+            time.time(),
+            f'Log queue overloaded: {dropped} messages dropped, '
+            f'{sampled_out} sampled out',
+            RESET
+        ))
+
+
+_pipeline = _LogPipeline()
 
 
 def log_message(message: str, colour: str = RESET) -> None:
-    print(f'{colour}{message}{RESET}')
-    logging.info(message)
+    # Never blocks, the message is written by the log writer thread
+    _pipeline.put(message, colour)
+
+
+def log_stats() -> dict:
+    return _pipeline.stats()
+
+
+def shutdown_logging() -> None:
+    # Writes what is still queued and stops the writer. Runs at exit
+    _pipeline.stop()
+
+
+def _restart_after_fork() -> None:
+    # The writer thread does not survive fork, and records queued by the
+    # parent are its to write
+    global _pipeline
+    _pipeline = _LogPipeline()
+
+
+atexit.register(shutdown_logging)
+os.register_at_fork(after_in_child=_restart_after_fork)
 
 
 if __name__ == '__main__':
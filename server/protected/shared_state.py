@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Rate limit and blacklist state shared by every worker process.
+# A fixed-size hash table lives in a multiprocessing.shared_memory block
+# created by the supervisor before forking, so workers see one consistent
+# view of each client no matter which process accepted the connection.
+# - Clients hash to a bucket of SLOTS_PER_BUCKET slots, and a full bucket
+#   evicts its least recently seen client, so memory is fixed up front
+# - There is no global lock: each bucket is guarded by one of LOCK_STRIPES
+#   locks, so workers only contend when they touch the same stripe
+# - Each slot holds the GCRA arrival time used by RateLimiter and the time
+#   until which the client is banned
+import time
+import struct
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+
+NUM_BUCKETS = 16_384
+SLOTS_PER_BUCKET = 8
+LOCK_STRIPES = 64
+
+# Slot layout: client key, theoretical arrival time, banned until, last seen
+SLOT = struct.Struct('<Qddd')
+EMPTY_KEY = 0
+
+
+def client_key(client: str) -> int:
+    # Stable across processes, unlike hash(). Never equal to EMPTY_KEY
+    digest = hashlib.blake2b(client.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | 1
+
+
+class SharedClientTable:
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        num_buckets: int = NUM_BUCKETS,
+        slots_per_bucket: int = SLOTS_PER_BUCKET,
+        lock_stripes: int = LOCK_STRIPES
+    ) -> None:
+        # Must be created before the workers are forked
+        self.emission_interval = window / limit
+        self.burst_tolerance = window - self.emission_interval
+        self.num_buckets = num_buckets
+        self.slots_per_bucket = slots_per_bucket
+
+        size = num_buckets * slots_per_bucket * SLOT.size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.shm.buf[:size] = bytes(size)
+        self.locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+
+    def allow(self, client: str, now: float | None = None) -> bool:
+        # Same GCRA check as RateLimiter.allow, on the shared slot
+        if now is None:
+            now = time.monotonic()
+
+        key = client_key(client)
+        with self._lock(key):
+            offset = self._find_slot(key, now)
+            _, tat, banned_until, _ = SLOT.unpack_from(self.shm.buf, offset)
+            tat = max(tat, now)
+            if tat - now > self.burst_tolerance:
+                SLOT.pack_into(self.shm.buf, offset, key, tat, banned_until, now)
+                return False
+
+            SLOT.pack_into(
+                self.shm.buf, offset,
+                key, tat + self.emission_interval, banned_until, now
+            )
+            return True
+
+    def ban(self, client: str, duration: float) -> None:
+        now = time.monotonic()
+        key = client_key(client)
+        with self._lock(key):
+            offset = self._find_slot(key, now)
+            _, tat, banned_until, _ = SLOT.unpack_from(self.shm.buf, offset)
+            banned_until = max(banned_until, now + duration)
+            SLOT.pack_into(self.shm.buf, offset, key, tat, banned_until, now)
+
+    def is_banned(self, client: str) -> bool:
+        # Read without the stripe lock, a torn read can only delay a ban
+        # by one connection
+        key = client_key(client)
+        base = self._bucket_offset(key)
+        for slot in range(self.slots_per_bucket):
+            offset = base + slot * SLOT.size
+            slot_key, _, banned_until, _ = SLOT.unpack_from(self.shm.buf, offset)
+            if slot_key == key:
+                return banned_until > time.monotonic()
+        return False
+
+    def close(self, unlink: bool = False) -> None:
+        # The supervisor unlinks the block once every worker has exited
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+    def _lock(self, key: int):
+        return self.locks[(key % self.num_buckets) % len(self.locks)]
+
+    def _bucket_offset(self, key: int) -> int:
+        return (key % self.num_buckets) * self.slots_per_bucket * SLOT.size
+
+    def _find_slot(self, key: int, now: float) -> int:
+        # Offset of the client's slot, claiming an empty or the least
+        # recently seen slot of the bucket if it has none. Needs the lock
+        base = self._bucket_offset(key)
+        victim, victim_seen = base, now
+        for slot in range(self.slots_per_bucket):
+            offset = base + slot * SLOT.size
+            slot_key, _, banned_until, last_seen = SLOT.unpack_from(
+                self.shm.buf, offset
+            )
+            if slot_key == key:
+                return offset
+
+            # Banned clients are kept until their ban runs out
+            if slot_key == EMPTY_KEY:
+                last_seen = float('-inf')
+            elif banned_until > now:
+                last_seen = banned_until
+            if last_seen < victim_seen:
+                victim, victim_seen = offset, last_seen
+
+        SLOT.pack_into(self.shm.buf, victim, key, 0.0, 0.0, now)
+        return victim
@@ -1,21 +1,55 @@
 #!/usr/bin/env python3
 # Uses HTTP/1.1 to host a simple HTTP server with the limitations:
-# - No caching
+# - Caching is left to clients, through ETag/Last-Modified validators
+#   (conditional requests get 304 Not Modified) and Cache-Control
+# - Text assets are sent gzip or brotli compressed to clients accepting it,
+#   from variants compressed once when the asset is loaded
+# - Byte range requests (Range, If-Range) get 206 Partial Content, several
+#   ranges as multipart/byteranges, or 416 if none can be satisfied
 # - No HTTPS (no encryption)
 # - Only HEAD & GET requests (static files only)
-# Make the server easier to DoS/DDoS by setting a semaphore to
-# only be able to handle a certain amount of connections, simulating
-# a server with limited resources
+# Make the server easier to DoS/DDoS by only being able to handle
+# a certain amount of connections, simulating a server with limited
+# resources. The limit adapts to the latency of the requests served
 import socket
 import os
+import errno
+import sys
 import time
+import signal
 import datetime
 import threading
-from collections import defaultdict
+import selectors
+import itertools
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import io
 from http import HTTPStatus
-from server_logs import log_message
+from server_logs import log_message, log_stats, shutdown_logging
+from asset_cache import AssetCache
+from access_log import AccessLog
+from metrics import MetricsRegistry, MetricsServer
+from profiling import NULL_TIMER, PhaseTimings, SamplingProfiler
+from rate_limiter import RateLimiter
+from shared_state import SharedClientTable
+from blocklist import Blocklist
+from attack_detector import AttackDetector, SUSPECT
+from request_parser import RequestParser, ParsedRequest, RequestError
+from timer_wheel import TimerWheel
+from admission_queue import AdmissionQueue, MAX_QUEUE_DEPTH
+from concurrency_limit import AdaptiveLimit
+from work_stage import WorkStage
+from threads import start_thread
+from response_templates import ResponseTemplates, STATUS_LINES, build_response
+from byte_ranges import (
+    MULTIPART_CONTENT_TYPE, content_range, multipart_parts, parse_range
+)
 
 
 LOCALHOST, PORT = '127.0.0.1', 8080
@@ -23,14 +57,120 @@ LOCALHOST, PORT = '127.0.0.1', 8080
 # Fake processing time
 PROCESS_TIME = 2
 
-# Rate limiting
+# Processing runs on a pool separate from connection I/O. A thread pool
+# has a worker for every connection the adaptive limit can admit, so an
+# admitted request never waits for the pool and the latency the limit
+# adapts to is the processing itself. A process pool, for CPU-bound work,
+# has WORK_PROCESSES workers and the limit finds how many it can keep busy
+WORK_PROCESSES = os.cpu_count() or 1
+WORK_EXECUTOR = 'thread'
+
+# Ceiling for the adaptive limit on concurrent connections, the limit
+# itself is found from request latency while running
+MAX_CONNECTIONS = 1000
+
+# Under load, queued connections are admitted by client reputation (from
+# the attack detector), trusted clients first. Suspect clients only get a
+# slot straight away while under SUSPECT_SHARE of the limit is in use, so
+# a flood from them leaves room for everyone else
+SUSPECT_SHARE = 0.5
+
+# Every connection, served or queued, holds a descriptor. They are kept
+# within the process's descriptor limit (RLIMIT_NOFILE), less FD_HEADROOM
+# for the listening socket, logs, metrics and static files. The admission
+# queue gets at most QUEUE_FD_SHARE of what is left
+FD_HEADROOM = 64
+QUEUE_FD_SHARE = 0.125
+
+# Rate limiting, per client IP: a burst of REQUEST_LIMIT requests,
+# refilled evenly over TIME_WINDOW seconds. The rate limiter also holds
+# the IP blacklist, and is shared between processes with several workers
 REQUEST_LIMIT = 10
 TIME_WINDOW = 30
-ip_blacklist = set()
 
-# Connection timeout
+# CIDR ranges refused straight after accept, one per line with an optional
+# TTL in seconds. Edits to the file are picked up while running
+BLOCKLIST_FILE = 'blocklist.txt'
+
+# Sent as-is to throttled clients before their request is handled
+TOO_MANY_REQUESTS_RESPONSE = build_response(
+    HTTPStatus.TOO_MANY_REQUESTS,
+    {'Retry-After': TIME_WINDOW // REQUEST_LIMIT}
+)
+
+# Connection timeout, for the first request to start arriving and for
+# each write of a response to make progress, so large bodies are only cut
+# off when the client stops reading. Once it starts, the request head has
+# to arrive within the deadline and minimum data rate enforced by
+# RequestParser
 REQUEST_TIMEOUT = 5
 
+# Persistent connections: idle time allowed between requests
+# and the number of requests served before the connection is closed
+KEEPALIVE_TIMEOUT = 5
+MAX_KEEPALIVE_REQUESTS = 100
+
+# Prebuilt status lines, error responses and connection headers
+RESPONSES = ResponseTemplates(KEEPALIVE_TIMEOUT, MAX_KEEPALIVE_REQUESTS)
+
+# Serving mode: 'threaded' starts a thread per connection,
+# 'selector' multiplexes every connection on a single event loop.
+# Either way the header, idle and processing deadlines of every connection
+# are kept on one timer wheel, checked every tick of the wheel
+SERVER_MODE = 'threaded'
+RECV_SIZE = 4096
+
+# The threaded accept loop wakes at least every ACCEPT_TIMEOUT seconds,
+# so a shutdown signal is acted on while no connections arrive
+ACCEPT_TIMEOUT = 0.5
+
+# Accepting again after running out of descriptors or memory waits
+# ACCEPT_BACKOFF seconds. A descriptor held in reserve is freed meanwhile
+# to accept and close the pending connection, so the client is refused
+# instead of left waiting in the listen queue
+ACCEPT_BACKOFF = 0.05
+ACCEPT_RESOURCE_ERRORS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM}
+
+# Pre-forked worker processes. With more than one worker each process
+# runs its own server on the same port, and the supervisor restarts
+# workers that crash after waiting WORKER_RESTART_DELAY seconds
+NUM_WORKERS = 1
+WORKER_RESTART_DELAY = 1
+REUSE_PORT_AVAILABLE = hasattr(socket, 'SO_REUSEPORT')
+
+# Metrics in the Prometheus text format, served on a local port of their
+# own. Prefork workers each serve theirs on the ports after it.
+# None turns the endpoint off, metrics are still kept
+METRICS_PORT = 9100
+
+# Per-phase request timing is opt-in, with PHASE_TIMING=1 in the
+# environment, and added to the metrics. The sampling profiler is started
+# and stopped by sending PROFILE_SIGNAL to a worker (or the supervisor,
+# which passes it on to every worker)
+PHASE_TIMING = os.environ.get('PHASE_TIMING') == '1'
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+# Zero-copy file bodies, falls back to buffered writes when unavailable
+SENDFILE_AVAILABLE = hasattr(os, 'sendfile')
+
+# Headers and in-memory bodies go out in one scatter-gather write of up
+# to MAX_IOV buffers, or one buffer per send without sendmsg
+SENDMSG_AVAILABLE = hasattr(socket.socket, 'sendmsg')
+MAX_IOV = 64
+
+# Most bytes a response sends before returning to the caller, which
+# pushes its write deadline back on progress
+SEND_CHUNK = 256 * 1024
+
+# Static files are served from the directory the server is started in.
+# Cache-Control policy by file path pattern, the first match applies
+ROOT_DIR = os.getcwd()
+CACHE_CONTROL = {
+    '*.html': 'no-cache',
+    '*.jpg': 'public, max-age=86400',
+}
+ASSET_CACHE = AssetCache(cache_control=CACHE_CONTROL)
+
 # ANSI colour escape codes
 GREEN = '\033[32m'
 BLUE = '\033[34m'
@@ -41,29 +181,46 @@ YELLOW = '\033[33m'
 class HTTPRequestHandler:
     # Serves static files as-is. Only supports GET and HEAD.
     # POST returns 403 FORBIDDEN. Other commands return 405 METHOD NOT ALLOWED.
+    asset_cache = ASSET_CACHE
+
     def __init__(
         self,
-        request_stream: io.BufferedIOBase,
-        response_stream: io.BufferedIOBase
+        request: ParsedRequest,
+        response_stream: io.BufferedIOBase,
+        keep_alive: bool = False,
+        phases=NULL_TIMER
     ):
-        self.request_stream = request_stream
+        # The request is parsed by the server before it is handled.
+        # keep_alive says whether the server allows the connection to stay
+        # open, close_connection is the outcome once the request is read.
+        # phases is the connection's timer, for per-phase timing
         self.response_stream = response_stream
+        self.keep_alive = keep_alive
+        self.request = request
+        self.phases = phases
+        self.close_connection = True
         self.command = ''
         self.path = ''
-        self.headers = {
-            'Content-Type': 'text/html',
-            'Content-Length': '0',
-            'Connection': 'close'
-        }
-        self.data = ''
+        self.request_version = ''
+        self.request_headers = {}
+        self.status_code = None
+        self.asset = None
+        # The asset itself, or its compressed variant for this request
+        self.representation = None
         self.handle()
 
     def handle(self) -> None:
         # Anything but GET or HEAD will return 405
         # POST will return a 403
         self._parse_request()
+        self._set_persistence()
+        self._respond()
+        self.response_stream.flush()
 
-        if not self._validate_path():
+    def _respond(self) -> None:
+        found = self._validate_path()
+        self.phases.lap('resolve')
+        if not found:
             return self._return_404()
 
         if self.command == 'POST':
@@ -72,101 +229,226 @@ class HTTPRequestHandler:
         if self.command not in ('GET', 'HEAD'):
             return self._return_405()
 
+        self.representation = self.asset.select(
+            self.request_headers.get('accept-encoding')
+        )
+        if self._respond_not_modified():
+            return
+
         command = getattr(self, f'handle_{self.command}')
         command()
 
     def handle_GET(self) -> None:
-        # Writes headers and the file to the socket.
+        # Writes headers and the file to the socket, or only the requested
+        # ranges of it
+        if self._respond_partial():
+            return
+
         self.handle_HEAD()
+        self._write_body(0, self.representation.size)
+        self.phases.lap('body')
+
+    def handle_HEAD(self) -> None:
+        # Writes headers to the socket. Default to 200 OK.
+        # The cached head already holds the status line and entity
+        # headers, only the connection headers depend on the request
+        self.status_code = 200
+        self.response_stream.write(self.representation.response_head)
+        self.response_stream.write(RESPONSES.connection(self.close_connection))
+        self.response_stream.flush()
+        self.phases.lap('head')
+
+    def _respond_partial(self) -> bool:
+        # Answers a range request with 206 or 416. Returns False if the
+        # whole representation is to be sent instead: no Range header, one
+        # to ignore, or an If-Range validator that is no longer current
+        range_header = self.request_headers.get('range')
+        if range_header is None or not self._if_range_current():
+            return False
+
+        representation = self.representation
+        size = representation.size
+        ranges = parse_range(range_header, size)
+        if ranges is None:
+            return False
+
+        connection = RESPONSES.connection(self.close_connection)
+        if not ranges:
+            self.status_code = 416
+            self.response_stream.write(
+                STATUS_LINES[416]
+                + f'Content-Type: text/html\r\nContent-Length: 0\r\n'
+                  f'Content-Range: bytes */{size}\r\n'.encode()
+                + connection
+            )
+            return True
+
+        self.status_code = 206
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.response_stream.write(
+                representation.partial_head
+                + f'Content-Type: {self.asset.content_type}\r\n'
+                  f'Content-Length: {end - start + 1}\r\n'
+                  f'Content-Range: {content_range(start, end, size)}\r\n'.encode()
+                + connection
+            )
+            self.phases.lap('head')
+            self._write_body(start, end - start + 1)
+            self.phases.lap('body')
+            return True
+
+        parts, closing, length = multipart_parts(
+            ranges, self.asset.content_type, size
+        )
+        self.response_stream.write(
+            representation.partial_head
+            + f'Content-Type: {MULTIPART_CONTENT_TYPE}\r\n'
+              f'Content-Length: {length}\r\n'.encode()
+            + connection
+        )
+        self.phases.lap('head')
+        for part_head, offset, count in parts:
+            self.response_stream.write(part_head)
+            self._write_body(offset, count)
+        self.response_stream.write(closing)
+        self.response_stream.flush()
+        self.phases.lap('body')
+        return True
+
+    def _if_range_current(self) -> bool:
+        # If-Range holds an entity tag, compared strongly so weak tags never
+        # match, or a date which must be exactly the Last-Modified date
+        if_range = self.request_headers.get('if-range')
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            return if_range == self.representation.etag
+
+        date = _parse_http_date(if_range)
+        return date is not None and self.asset.last_modified == date
+
+    def _write_body(self, offset: int, count: int) -> None:
+        # Writes count bytes of the representation from offset. Cached
+        # bodies are written from memory without copying, larger files are
+        # sent from the page cache with sendfile when possible. Compressed
+        # variants are always in memory
+        body = self.representation.body
+        if body is not None:
+            self.response_stream.write(memoryview(body)[offset:offset + count])
+            self.response_stream.flush()
+            return
+
+        if SENDFILE_AVAILABLE and hasattr(self.response_stream, 'write_file'):
+            self.response_stream.write_file(self.path, offset, count)
+            return
 
         with open(self.path, 'rb') as f:
-            body = f.read()
+            f.seek(offset)
+            body = f.read(count)
 
         self.response_stream.write(body)
         self.response_stream.flush()
 
-    def handle_HEAD(self) -> None:
-        # Writes headers to the socket. Default to 200 OK
-        self._write_response_line(200)
-        self._write_headers(
-            **{
-                'Content-Length': os.path.getsize(self.path)
-            }
-        )
-        self.response_stream.flush()
+    def _respond_not_modified(self) -> bool:
+        # Answers a conditional request with 304 if the client's copy is
+        # current. If-None-Match takes precedence over If-Modified-Since
+        if_none_match = self.request_headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            # Weak comparison, as for any If-None-Match
+            current = '*' in tags or self.representation.etag in (
+                tag.removeprefix('W/') for tag in tags
+            )
+        else:
+            current = self._not_modified_since(
+                self.request_headers.get('if-modified-since')
+            )
 
-    def _write_response_line(self, status_code: int) -> None:
-        reponse_line = f'HTTP/1.1 {status_code} {HTTPStatus(status_code).phrase} \r\n'
-        self.response_stream.write(reponse_line.encode())
+        if not current:
+            return False
 
-    def _write_headers(self, *args, **kwargs) -> None:
-        headers_copy = self.headers.copy()
-        headers_copy.update(**kwargs)
-        header_lines = '\r\n'.join(
-            f'{k}: {v}' for k, v in headers_copy.items()
-        )
-        self.response_stream.write(header_lines.encode())
+        self.status_code = 304
+        self.response_stream.write(self.representation.not_modified_head)
+        self.response_stream.write(RESPONSES.connection(self.close_connection))
+        self.phases.lap('head')
+        return True
 
-        # Mark the end of the headers
-        self.response_stream.write(b'\r\n\r\n')
+    def _not_modified_since(self, date: str | None) -> bool:
+        if date is None:
+            return False
+        since = _parse_http_date(date)
+        # Invalid dates are ignored
+        return since is not None and self.asset.last_modified <= since
+
+    def _write_error(self, status_code: int) -> None:
+        # Prebuilt bodiless response
+        self.status_code = status_code
+        self.response_stream.write(
+            RESPONSES.error(status_code, self.close_connection)
+        )
+        self.phases.lap('head')
 
     def _parse_request(self):
-        # Parse the request line
-        requestline = self.request_stream.readline().decode()
-        requestline = requestline.rstrip('\r\n')
-
-        if not requestline:
-            raise ValueError("Empty requestline received")
-
-        components = requestline.split(' ')
-        if len(components) < 3:
-            raise ValueError("Invalid HTTP request line")
-        self.command, self.path, *_ = components
-
-        # Parse the headers
-        headers = {}
-        line = self.request_stream.readline().decode()
-        while line not in ('\r\n', '\n', '\r', ''):
-            header = line.rstrip('\r\n').split(': ')
-            headers[header[0]] = header[1]
-            line = self.request_stream.readline().decode()
+        # Header names are lowercase in the parsed request
+        self.command = self.request.command
+        self.path = self.request.path
+        self.request_version = self.request.version
+        self.request_headers = self.request.headers
+
+    def _set_persistence(self) -> None:
+        # HTTP/1.1 connections persist unless either side asks to close,
+        # HTTP/1.0 ones only persist if the client asks for keep-alive.
+        # Request bodies are never read, so a request with one must close
+        # the connection to keep the next request's framing intact
+        connection = self.request_headers.get('connection', '').lower()
+        if self.request_version == 'HTTP/1.1':
+            persistent = 'close' not in connection
+        else:
+            persistent = 'keep-alive' in connection
+
+        has_body = (
+            self.request_headers.get('content-length', '0') != '0'
+            or 'transfer-encoding' in self.request_headers
+        )
+
+        self.close_connection = not (self.keep_alive and persistent) or has_body
 
     def _validate_path(self) -> bool:
-        self.path = os.path.join(os.getcwd(), self.path.lstrip('/'))
-        if os.path.isdir(self.path):
-            self.path = os.path.join(self.path, 'index.html')
-        elif os.path.isfile(self.path):
-            pass
+        # Directories resolve to their index.html through the asset cache.
+        # Paths that '..' segments take outside ROOT_DIR are not found,
+        # before the cache could load them
+        path = os.path.normpath(os.path.join(ROOT_DIR, self.path.lstrip('/')))
+        if os.path.commonpath([ROOT_DIR, path]) != ROOT_DIR:
+            return False
 
-        if not os.path.exists(self.path):
+        self.path = path
+        self.asset = self.asset_cache.lookup(self.path)
+        if self.asset is None:
             return False
 
+        self.path = self.asset.path
         return True
 
     def _return_400(self) -> None:
         # Error 400: BAD_REQUEST
-        self._write_response_line(400)
-        self._write_headers()
+        self._write_error(400)
 
     def _return_403(self) -> None:
         # Error 403: FORBIDDEN
-        self._write_response_line(403)
-        self._write_headers()
+        self._write_error(403)
 
     def _return_404(self) -> None:
         # Error 404: NOT FOUND
-        self._write_response_line(404)
-        self._write_headers()
+        self._write_error(404)
 
     def _return_405(self) -> None:
         # Error 405: METHOD NOT ALLOWED
-        self._write_response_line(405)
-        self._write_headers()
+        self._write_error(405)
 
-    def _return_429(self, response_stream) -> None:
+    def _return_429(self) -> None:
         # Error 429: TOO MANY REQUESTS
-        self._write_response_line(response_stream, 429)
-        self._write_headers(response_stream)
+        self._write_error(429)
 
 
 class TCPServer:
@@ -174,92 +456,421 @@ class TCPServer:
         self,
         socket_address: tuple[str, int],
         request_handler: HTTPRequestHandler,
-        max_connections: int
+        max_connections: int = MAX_CONNECTIONS,
+        reuse_port: bool = False,
+        sock: socket.socket | None = None,
+        rate_limiter: RateLimiter | SharedClientTable | None = None,
+        blocklist: Blocklist | None = None,
+        detector: AttackDetector | None = None,
+        work_stage: WorkStage | None = None,
+        access_log: AccessLog | None = None,
+        metrics_port: int | None = None
     ) -> None:
-        # Create TCP socket using IPv4 address
-        # Use a semaphore to manage the concurrent connections
+        # Create TCP socket using IPv4 address, or use a listening socket
+        # shared by the supervisor. With reuse_port several worker processes
+        # bind the same port and the kernel balances connections between them
+        # Concurrent connections are capped by an adaptive limit, at most
+        # max_connections
         self.request_handler = request_handler
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(socket_address)
-        self.sock.listen()
-        self.semaphore = threading.Semaphore(max_connections)
+        self.sock = sock if sock is not None else _create_listen_socket(
+            socket_address, reuse_port
+        )
+        self.reserve_fd = os.open(os.devnull, os.O_RDONLY)
+
+        # Served and queued connections together stay within the
+        # descriptors left to clients
+        fd_budget = _descriptor_budget()
+        queue_depth = min(MAX_QUEUE_DEPTH, int(fd_budget * QUEUE_FD_SHARE))
+        max_connections = max(min(max_connections, fd_budget - queue_depth), 1)
+        if queue_depth < MAX_QUEUE_DEPTH:
+            log_message(
+                f'Descriptor limit allows {max_connections} connections '
+                f'and {queue_depth} queued',
+                YELLOW
+            )
+        self.concurrency_limit = AdaptiveLimit(max_connections)
+
+        # Connections over the limit wait here for a slot. The lock keeps
+        # a slot from being freed between a failed acquire and the enqueue
+        self.admission_queue = AdmissionQueue(queue_depth)
+        self.admission_lock = threading.Lock()
+
+        # An empty limiter or blocklist is falsy through __len__, so these
+        # are compared with None
+        self.rate_limiter = (
+            RateLimiter(REQUEST_LIMIT, TIME_WINDOW) if rate_limiter is None
+            else rate_limiter
+        )
+        self.blocklist = (
+            Blocklist(BLOCKLIST_FILE) if blocklist is None else blocklist
+        )
+        self.detector = detector or AttackDetector(self._ban_client)
+        self.timer_wheel = TimerWheel()
+        if work_stage is None:
+            workers = max_connections if WORK_EXECUTOR == 'thread' else WORK_PROCESSES
+            work_stage = WorkStage(simulate_processing, workers, WORK_EXECUTOR)
+        self.work_stage = work_stage
+        # Per process, so forked workers write their own files
+        self.access_log = access_log or AccessLog()
+
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.phase_timings = PhaseTimings(self.metrics, PHASE_TIMING)
+        self.metrics_server = None
+        if metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(
+                    (LOCALHOST, metrics_port), self.metrics
+                )
+            except OSError as error:
+                log_message(f'Metrics unavailable on port {metrics_port}: {error}', RED)
+
+    def _register_metrics(self) -> None:
+        # Counters are updated on the hot paths without locks, gauges are
+        # read from the server's state when scraped
+        metrics = self.metrics
+        self.accepted = metrics.counter(
+            'connections_accepted_total', 'Connections accepted from the listen socket'
+        )
+        self.refused = {
+            reason: metrics.counter(
+                'connections_refused_total',
+                'Connections closed without being served',
+                reason=reason
+            )
+            for reason in ('blocked', 'detected', 'limit', 'queue', 'resources')
+        }
+        self.queued = metrics.counter(
+            'connections_queued_total', 'Connections that waited for a slot'
+        )
+        self.opened = metrics.counter(
+            'connections_opened_total', 'Connections served'
+        )
+        self.closed = metrics.counter(
+            'connections_closed_total', 'Served connections closed'
+        )
+        self.throttled = metrics.counter(
+            'requests_throttled_total', 'Requests answered 429 by the rate limiter'
+        )
+        self.timeouts = metrics.counter(
+            'timeouts_total', 'Connections timed out reading or writing'
+        )
+        self.bytes_sent = metrics.counter(
+            'response_bytes_total', 'Bytes of responses sent'
+        )
+        self.latency = metrics.histogram(
+            'request_latency_seconds', 'Time from request to response sent'
+        )
 
-        self.connection_count = 0
-        self.connection_count_lock = threading.Lock()
-        self.client_requests = defaultdict(list)
+        metrics.gauge(
+            'connections_open', 'Connections being served',
+            lambda: self.opened.value - self.closed.value
+        )
+        metrics.gauge(
+            'concurrency_limit', 'Current adaptive connection limit',
+            lambda: self.concurrency_limit.stats()['limit']
+        )
+        metrics.gauge(
+            'connections_in_flight', 'Connection slots taken',
+            lambda: self.concurrency_limit.stats()['in_flight']
+        )
+        metrics.gauge(
+            'admission_queue_depth', 'Connections waiting for a slot',
+            lambda: len(self.admission_queue)
+        )
+        metrics.gauge(
+            'admission_queue_average_wait_seconds',
+            'Moving average of the wait of connections admitted from the queue',
+            lambda: self.admission_queue.stats()['average_wait']
+        )
+        metrics.gauge(
+            'admission_queue_oldest_wait_seconds',
+            'Wait so far of the longest waiting queued connection',
+            lambda: self.admission_queue.stats()['oldest_wait']
+        )
+        for reason in ('expired', 'shed', 'removed'):
+            metrics.counter_function(
+                'admission_queue_dropped_total',
+                'Queued connections dropped for waiting too long, shed by '
+                'CoDel or to make room, or removed once their client was banned',
+                lambda reason=reason: self.admission_queue.stats()[reason],
+                reason=reason
+            )
+        metrics.gauge(
+            'work_pending', 'Requests submitted to the work stage and not done',
+            lambda: self.work_stage.stats()['pending']
+        )
+        for reason in ('dropped', 'sampled_out'):
+            metrics.gauge(
+                'log_messages_lost', 'Log messages lost to an overloaded log queue',
+                lambda reason=reason: log_stats()[reason], reason=reason
+            )
 
     def serve_forever(self) -> None:
+        start_thread(self._reap_connections, name='reaper')
+        # Accepted sockets stay blocking, the timeout is only for accept
+        self.sock.settimeout(ACCEPT_TIMEOUT)
         try:
             while True:
-                conn, addr = self.sock.accept()
+                try:
+                    conn, addr = self.sock.accept()
+                except socket.timeout:
+                    continue
+                except OSError as error:
+                    self._accept_failed(error)
+                    continue
+                phases = self.phase_timings.timer()
+                self.accepted.inc()
 
-                if not self.semaphore.acquire(blocking=False):
-                    log_message(
-                        f'Too many connections: {addr} rejected',
-                        YELLOW
-                    )
+                if self._is_banned(addr):
+                    self.refused['blocked'].inc()
                     conn.close()
                     continue
 
-                # Handle the connection in a separate thread
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(conn, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                if self.detector.record_connection(addr[0]):
+                    self.refused['detected'].inc()
+                    conn.close()
+                    continue
+
+                phases.lap('accept')
+                with self.admission_lock:
+                    self._admit(conn, addr, phases)
 
         except KeyboardInterrupt:
             log_message('Finished successfully', GREEN)
         finally:
+            self._drop_queued(self.admission_queue.clear())
             self.sock.close()
 
-    def handle_client(self, conn, addr) -> None:
-        start_time = datetime.datetime.now()
+    def _accept_failed(self, error: OSError) -> None:
+        # Keeps serving through a lack of descriptors or memory, other
+        # errors from accept are raised
+        if error.errno not in ACCEPT_RESOURCE_ERRORS:
+            raise error
+        log_message(f'Accept failed: {error.strerror}, backing off', RED)
+
+        if self.reserve_fd is not None:
+            os.close(self.reserve_fd)
+            self.reserve_fd = None
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                pass
+            else:
+                self.refused['resources'].inc()
+                conn.close()
+        time.sleep(ACCEPT_BACKOFF)
+
+        # Taken again once a descriptor is free, on a later failure if not now
+        try:
+            self.reserve_fd = os.open(os.devnull, os.O_RDONLY)
+        except OSError:
+            pass
+
+    def _admit(self, conn, addr, phases) -> None:
+        # Starts the connection if there is a slot for its client,
+        # otherwise queues it by the client's reputation
+        reputation = self.detector.reputation(addr[0])
+        share = SUSPECT_SHARE if reputation == SUSPECT else 1.0
+        if self.concurrency_limit.try_acquire(share):
+            return self._start_client(conn, addr, phases)
+
+        entry = (conn, addr, phases)
+        dropped = self.admission_queue.enqueue(entry, reputation)
+        if entry in dropped:
+            dropped.remove(entry)
+            log_message(f'Too many connections: {addr} rejected', YELLOW)
+            self.refused['limit'].inc()
+            conn.close()
+        else:
+            self.queued.inc()
+            log_message(
+                f'Queued connection from {addr} '
+                f'({len(self.admission_queue)} waiting)',
+                YELLOW
+            )
+        self._drop_queued(dropped)
+
+    def _start_client(self, conn, addr, phases) -> None:
+        # Handle the connection in a separate thread
+        start_thread(self.handle_client, conn, addr, phases)
+
+    def _release_slot(self) -> None:
+        # Admits queued connections into the freed slot, and any the limit
+        # has grown by since, as far as the current limit allows. Queued
+        # connections are started outside the lock
+        admitted, dropped, banned = [], [], []
+        with self.admission_lock:
+            self.concurrency_limit.release()
+            while self.admission_queue and self.concurrency_limit.try_acquire():
+                entry, expired = self.admission_queue.dequeue()
+                dropped += expired
+                if entry is None:
+                    self.concurrency_limit.release()
+                    break
+                # The client may have been banned while it waited
+                if self._is_banned(entry[1]):
+                    self.concurrency_limit.release()
+                    banned.append(entry)
+                    continue
+                admitted.append(entry)
+
+        self._drop_queued(dropped)
+        self._drop_queued(banned, 'blocked')
+        for entry in admitted:
+            self._start_client(*entry)
+
+    def _review_queue(self, now: float) -> None:
+        # Run every tick. Drops queued connections that waited too long or
+        # whose client has been banned since, and moves the rest to the
+        # class of their client's current reputation
+        self._drop_queued(self.admission_queue.expire(now))
+        self._drop_queued(
+            self.admission_queue.reclassify(self._queued_class), 'blocked'
+        )
+
+    def _queued_class(self, entry) -> int | None:
+        _, addr, _ = entry
+        if self._is_banned(addr):
+            return None
+        return self.detector.reputation(addr[0])
+
+    def _record_latency(self, time_taken: float, status_code: int) -> None:
+        # Server errors count against the limit, client errors don't
+        self.latency.record(time_taken)
+        limit = self.concurrency_limit.record(time_taken, status_code >= 500)
+        if limit is not None:
+            log_message(
+                f'Concurrency limit lowered to {int(limit)} '
+                f'({time_taken:.2f}s response)',
+                YELLOW
+            )
+
+    def _log_access(
+        self,
+        addr,
+        request: ParsedRequest | None,
+        status_code: int,
+        length: int,
+        latency: float
+    ) -> None:
+        # Requests that could not be parsed are logged without method and path
+        method, path = ('', '') if request is None else (request.command, request.path)
+        self.access_log.record(addr[0], method, path, status_code, length, latency)
+        self.bytes_sent.inc(length)
+        if status_code == 429:
+            self.throttled.inc()
+        elif status_code == 408:
+            self.timeouts.inc()
+
+    def _drop_queued(self, entries: list, reason: str = 'queue') -> None:
+        # Queued connections that waited too long, were shed, or whose
+        # client was banned while they waited
+        for conn, addr, _ in entries:
+            log_message(f'Dropped queued connection from {addr}', YELLOW)
+            self.refused[reason].inc()
+            conn.close()
+
+    def handle_client(self, conn, addr, phases=NULL_TIMER) -> None:
+        # Incomplete until a request is answered, and again if the
+        # connection times out or fails part way through the next one
+        phases.lap('queue_wait')
+        opened = time.monotonic()
+        incomplete = True
+        watch = _ConnectionWatch(conn)
 
         try:
-            with conn:
-                log_message(f'Accepted connection from {addr}', GREEN)
-                conn.settimeout(REQUEST_TIMEOUT)
-                self.update_connection_count(increment=True)
+            log_message(f'Accepted connection from {addr}', GREEN)
+            self.update_connection_count(increment=True)
 
-                request_stream = conn.makefile('rb')
-                response_stream = conn.makefile('wb')
+            parser = RequestParser()
 
-                # Handle request
-                handler = self.request_handler(
-                    request_stream=request_stream,
-                    response_stream=response_stream
+            # Serve requests until either side closes the connection.
+            # Pipelined requests wait in the parser's buffer
+            requests_handled = 0
+            while requests_handled < MAX_KEEPALIVE_REQUESTS:
+                request = self._read_request(
+                    watch, parser, requests_handled, phases
                 )
+                if request is None:
+                    break
 
-                # Rate limiting
-                current_time = time.time()
-                self.client_requests[addr] = [
-                    t for t in self.client_requests[addr] if current_time - t < TIME_WINDOW
-                ]
-
-                if len(self.client_requests[addr]) >= REQUEST_LIMIT:
+                # Rate limiting, once the request is parsed and before it is
+                # handled or processed
+                if not self.rate_limiter.allow(addr[0]):
                     log_message(f'Throttling connection from {addr}', YELLOW)
-                    handler._return_429(response_stream)
+                    conn.sendall(TOO_MANY_REQUESTS_RESPONSE)
+                    incomplete = False
+                    self.detector.record_response(addr[0], 429)
+                    self._log_access(
+                        addr, request, 429, len(TOO_MANY_REQUESTS_RESPONSE), 0.0
+                    )
                     return
 
-                self.client_requests[addr].append(start_time)
+                start_time = datetime.datetime.now()
+                requests_handled += 1
+
+                # Processing runs on the work stage, without a deadline
+                self.timer_wheel.cancel(watch.timer)
+                try:
+                    self.work_stage.run(request)
+                    phases.lap('processing')
+                except Exception as error:
+                    log_message(f'Processing failed for {addr}: {error}', RED)
+                    conn.sendall(RESPONSES.error(500))
+                    incomplete = False
+                    self.detector.record_response(addr[0], 500)
+                    time_taken = (datetime.datetime.now() - start_time).total_seconds()
+                    self._log_access(
+                        addr, request, 500, len(RESPONSES.error(500)), time_taken
+                    )
+                    return
 
-                # Simulate heavy process
-                time.sleep(PROCESS_TIME)
+                # Handle request, as soon as the work is done
+                response = ResponseBuffer()
+                handler = self.request_handler(
+                    response_stream=response,
+                    keep_alive=requests_handled < MAX_KEEPALIVE_REQUESTS,
+                    request=request,
+                    phases=phases
+                )
+                self._send_response(watch, response)
+                phases.lap('send')
+                incomplete = False
+                self.detector.record_response(addr[0], handler.status_code)
 
                 end_time = datetime.datetime.now()
                 time_taken = (end_time - start_time).total_seconds()
+                self._record_latency(time_taken, handler.status_code)
+                self._log_access(
+                    addr, request, handler.status_code, response.length, time_taken
+                )
+                phases.finish()
                 if time_taken > PROCESS_TIME + 1:
                     log_message(
                         f'Slow response: {time_taken:.2f}s for {addr}',
                         YELLOW
                     )
 
+                if handler.close_connection:
+                    break
+
         except socket.timeout:
+            incomplete = True
+            self.timeouts.inc()
             log_message(f'Connection from {addr} timed out', YELLOW)
 
+        except RequestError as error:
+            incomplete = True
+            log_message(f'Bad request from {addr}: {error}', YELLOW)
+            response = RESPONSES.error(error.status_code)
+            try:
+                conn.sendall(response)
+            except OSError:
+                pass
+            else:
+                self._log_access(addr, None, error.status_code, len(response), 0.0)
+
         except BrokenPipeError:
             log_message(
                 f'Connection error from {addr}: Broken pipe (client disconnected)',
@@ -267,54 +878,857 @@ class TCPServer:
             )
 
         except Exception as error:
+            incomplete = True
             log_message(f'Connection error from {addr}: {error}', RED)
 
         finally:
-            self.semaphore.release()
+            # Closed here so the error responses above can still be sent
+            conn.close()
+            self.timer_wheel.cancel(watch.timer)
+            self._release_slot()
+            phases.lap('close')
+            phases.finish()
             log_message(f'Closed connection from {addr}', BLUE)
             self.update_connection_count(increment=False)
+            self.detector.record_close(
+                addr[0], time.monotonic() - opened, incomplete
+            )
+
+    def _send_response(self, watch: '_ConnectionWatch', response: 'ResponseBuffer') -> None:
+        # The socket blocks, and each send returns after at most about
+        # SEND_CHUNK bytes, so the write deadline is renewed while the
+        # client keeps reading. The reaper shuts the socket down once it
+        # passes, which fails the send
+        try:
+            while True:
+                self._set_deadline(
+                    watch, time.monotonic() + REQUEST_TIMEOUT, reading=False
+                )
+                if response.send(watch.conn):
+                    return
+        except OSError as error:
+            if watch.expired:
+                raise socket.timeout('Response not read in time') from error
+            raise
+        finally:
+            response.close()
+
+    def _ban_client(self, client: str, duration: float, reason: str) -> None:
+        # Called by the detector. The blocklist entry refuses the client on
+        # this process's accept path, and the rate limiter's ban carries it
+        # to the other workers when the client table is shared
+        log_message(f'Banning {client} for {duration:.0f}s: {reason}', RED)
+        self.blocklist.add(client, ttl=duration)
+        self.rate_limiter.ban(client, duration)
+
+    def _is_banned(self, addr) -> bool:
+        # Checked before a thread or connection slot is spent on the client,
+        # and again for queued connections. The blocklist file is reloaded
+        # by a thread of its own
+        return (
+            self.blocklist.contains(addr[0])
+            or self.rate_limiter.is_banned(addr[0])
+        )
+
+    def _read_request(
+        self,
+        watch: '_ConnectionWatch',
+        parser: RequestParser,
+        requests_handled: int,
+        phases=NULL_TIMER
+    ) -> ParsedRequest | None:
+        # Receives until the parser has a complete request. Returns None if
+        # the client closed the connection or an idle keep-alive connection
+        # timed out between requests, which are both normal ways to end.
+        # Once a request starts arriving, the deadline is the parser's, so
+        # trickling bytes doesn't extend it
+        while True:
+            now = time.monotonic()
+            phases.lap('read')
+            request = parser.next_request(now)
+            phases.lap('parse')
+            if request is not None:
+                return request
+
+            if parser.pending:
+                deadline = parser.deadline()
+                if deadline <= now:
+                    raise parser.expired(now)
+            elif requests_handled:
+                deadline = now + KEEPALIVE_TIMEOUT
+            else:
+                deadline = now + REQUEST_TIMEOUT
+            self._set_deadline(watch, deadline, reading=True)
+
+            # The reaper shuts down the read side when the deadline passes,
+            # which ends the recv like the client closing would
+            try:
+                data = watch.conn.recv(RECV_SIZE)
+            except OSError:
+                if not watch.expired:
+                    raise
+                data = b''
+
+            if watch.expired:
+                if parser.pending:
+                    raise parser.expired(time.monotonic())
+                if requests_handled:
+                    return None
+                raise socket.timeout('Request not received in time')
+
+            if not data:
+                if parser.pending:
+                    raise ConnectionError('Client closed mid-request')
+                return None
+            parser.feed(data, time.monotonic())
+
+    def _set_deadline(
+        self,
+        watch: '_ConnectionWatch',
+        deadline: float,
+        reading: bool
+    ) -> None:
+        # Each connection has one deadline at a time, replacing the last
+        watch.reading = reading
+        watch.timer = self.timer_wheel.reschedule(watch.timer, deadline, watch)
+
+    def _reap_connections(self) -> None:
+        # Interrupts connection threads whose deadline has passed, a batch
+        # every tick. While reading only the read side is shut down, so an
+        # error response can still be sent; a stuck write needs both
+        while True:
+            time.sleep(self.timer_wheel.tick)
+            now = time.monotonic()
+            self._review_queue(now)
+            for watch in self.timer_wheel.advance(now):
+                watch.expired = True
+                try:
+                    watch.conn.shutdown(
+                        socket.SHUT_RD if watch.reading else socket.SHUT_RDWR
+                    )
+                except OSError:
+                    pass
 
     def update_connection_count(self, increment: bool) -> None:
-        with self.connection_count_lock:
-            self.connection_count += 1 if increment else -1
-            log_message(f'Connection count: {self.connection_count}')
+        # Sharded counters instead of a locked count, see connections_open
+        (self.opened if increment else self.closed).inc()
 
     def __enter__(self) -> 'TCPServer':
         return self
 
     def __exit__(self, *args) -> None:
+        for line in self.phase_timings.report():
+            log_message(f'Phase {line}')
+        self.work_stage.shutdown()
+        self.blocklist.close()
+        self.access_log.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.reserve_fd is not None:
+            os.close(self.reserve_fd)
         self.sock.close()
 
 
-def get_max_connections() -> int:
-    try:
-        max_conns = int(input('Enter the maximum number of connections: '))
+class _ConnectionWatch:
+    # Deadline of a threaded connection, kept on the server's timer wheel
+    # instead of as a socket timeout, so the socket itself stays blocking
+    __slots__ = ('conn', 'timer', 'reading', 'expired')
+
+    def __init__(self, conn: socket.socket) -> None:
+        self.conn = conn
+        self.timer = None
+        self.reading = True
+        self.expired = False
+
+
+class ResponseBuffer:
+    # Response stream that collects the response as byte chunks and
+    # (path, offset, count) file regions, then sends it in as few system
+    # calls as possible: each run of byte chunks in one sendmsg, and file
+    # regions with os.sendfile. Works on blocking and non-blocking sockets
+    def __init__(self) -> None:
+        self.segments = deque()
+        self.body_file = None
+        # Total bytes of the response, and bytes sent so far
+        self.length = 0
+        self.sent = 0
+
+    def write(self, data: bytes | memoryview) -> int:
+        # Chunks are kept as given, so memoryviews of cached bodies are
+        # sent without a copy
+        if data:
+            self.segments.append(data)
+            self.length += len(data)
+        return len(data)
+
+    def write_file(self, path: str, offset: int, count: int) -> None:
+        if count:
+            self.segments.append((path, offset, count))
+            self.length += count
+
+    def flush(self) -> None:
+        pass
+
+    def send(self, sock: socket.socket) -> bool:
+        # Sends as much as the socket accepts, up to about SEND_CHUNK bytes.
+        # Returns True once the whole response has been sent. A full
+        # non-blocking socket raises BlockingIOError, and partial writes
+        # resume on the next call
+        start = self.sent
+        while self.segments:
+            if self.sent - start >= SEND_CHUNK:
+                return False
+            if isinstance(self.segments[0], tuple):
+                if not self._send_file(sock):
+                    return False
+            elif not self._send_buffers(sock):
+                return False
+        self.close()
+        return True
 
-    except KeyboardInterrupt:
-        exit('\nCancelled server run')
+    def close(self) -> None:
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+
+    def _send_buffers(self, sock: socket.socket) -> bool:
+        # Sends the leading run of byte chunks, returns True if all of it
+        # was sent
+        if SENDMSG_AVAILABLE:
+            buffers = list(itertools.islice(
+                itertools.takewhile(
+                    lambda segment: not isinstance(segment, tuple),
+                    self.segments
+                ),
+                MAX_IOV
+            ))
+            sent = sock.sendmsg(_limit_buffers(buffers, SEND_CHUNK))
+        else:
+            buffers = [self.segments[0]]
+            sent = sock.send(memoryview(buffers[0])[:SEND_CHUNK])
+        self.sent += sent
+
+        for buffer in buffers:
+            if sent < len(buffer):
+                self.segments[0] = memoryview(buffer)[sent:]
+                return False
+            sent -= len(buffer)
+            self.segments.popleft()
+        return True
 
-    except ValueError:
-        exit("Invalid input: Max connections must be an integer")
+    def _send_file(self, sock: socket.socket) -> bool:
+        # The file stays open for the other parts of a multipart body
+        path, offset, count = self.segments[0]
+        if self.body_file is None or self.body_file.name != path:
+            self.close()
+            self.body_file = open(path, 'rb')
+
+        sent = os.sendfile(
+            sock.fileno(), self.body_file.fileno(), offset, min(count, SEND_CHUNK)
+        )
+        self.sent += sent
+        if 0 < sent < count:
+            self.segments[0] = (path, offset + sent, count - sent)
+            return False
+
+        # A short file (truncated while sending) ends the body early
+        self.segments.popleft()
+        return True
 
-    return max_conns
 
+class _SelectorConnection:
+    # Per-connection state kept by the event loop. An idle or slow client
+    # only costs this object and its buffers instead of a thread stack
+    __slots__ = (
+        'sock', 'addr', 'start_time', 'timer', 'phases', 'parser', 'request', 'response',
+        'processing', 'requests_handled', 'close_after',
+        'status_code', 'rejected', 'opened'
+    )
+
+    def __init__(self, sock: socket.socket, addr, phases=NULL_TIMER) -> None:
+        self.sock = sock
+        self.addr = addr
+        self.start_time = datetime.datetime.now()
+        self.timer = None
+        self.phases = phases
+        self.parser = RequestParser()
+        self.request = None
+        self.response = None
+        self.processing = False
+        self.requests_handled = 0
+        self.close_after = False
+        self.status_code = None
+        self.rejected = False
+        self.opened = time.monotonic()
+
+    @property
+    def idle(self) -> bool:
+        # Waiting between requests on a persistent connection
+        return self.requests_handled > 0 and not self.parser.pending
+
+
+class SelectorTCPServer(TCPServer):
+    # Serves every connection from one thread using non-blocking sockets
+    # and a selector. Each connection feeds its own incremental parser,
+    # and complete requests are handed to the same request handler with
+    # an in-memory response stream. Pipelined requests stay buffered in
+    # the parser until the previous one is finished.
+    # Processing runs on the work stage; finished work is queued for the
+    # loop, which a byte on a socket pair wakes to send the responses
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.connections = {}
+        self.finished_work = deque()
+
+        self.sock.setblocking(False)
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def serve_forever(self) -> None:
+        try:
+            while True:
+                events = self.selector.select(timeout=self.timer_wheel.tick)
+                for key, mask in events:
+                    if key.fileobj is self.sock:
+                        self._accept_connections()
+                    elif key.fileobj is self.wakeup_reader:
+                        self._send_finished_work()
+                    elif mask & selectors.EVENT_READ:
+                        self._on_readable(key.data)
+                    elif mask & selectors.EVENT_WRITE:
+                        self._write_response(key.data)
+
+                now = time.monotonic()
+                self._review_queue(now)
+                self._expire_connections(self.timer_wheel.advance(now))
+
+        except KeyboardInterrupt:
+            log_message('Finished successfully', GREEN)
+        finally:
+            self._drop_queued(self.admission_queue.clear())
+            for state in list(self.connections.values()):
+                self._close_connection(state)
+            self.selector.close()
+            self.wakeup_reader.close()
+            self.wakeup_writer.close()
+            self.sock.close()
 
-def run_tcp_server(max_conns: int) -> None:
+    def _accept_connections(self) -> None:
+        # Drain the accept queue so a burst is handled in one wake-up
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as error:
+                return self._accept_failed(error)
+            phases = self.phase_timings.timer()
+            self.accepted.inc()
+
+            if self._is_banned(addr):
+                self.refused['blocked'].inc()
+                conn.close()
+                continue
+
+            if self.detector.record_connection(addr[0]):
+                self.refused['detected'].inc()
+                conn.close()
+                continue
+
+            phases.lap('accept')
+            self._admit(conn, addr, phases)
+
+    def _start_client(self, conn, addr, phases) -> None:
+        phases.lap('queue_wait')
+        log_message(f'Accepted connection from {addr}', GREEN)
+        conn.setblocking(False)
+        state = _SelectorConnection(conn, addr, phases)
+        self._set_connection_deadline(state, time.monotonic() + REQUEST_TIMEOUT)
+        self.connections[conn] = state
+        self.selector.register(conn, selectors.EVENT_READ, state)
+        self.update_connection_count(increment=True)
+
+    def _on_readable(self, state: _SelectorConnection) -> None:
+        try:
+            data = state.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            log_message(f'Connection error from {state.addr}: {error}', RED)
+            return self._close_connection(state)
+
+        if not data:
+            return self._close_connection(state)
+
+        state.phases.lap('read')
+        state.parser.feed(data, time.monotonic())
+        self._handle_buffered_request(state)
+
+    def _handle_buffered_request(self, state: _SelectorConnection) -> None:
+        # Starts work on the first complete request in the buffer
+        try:
+            request = state.parser.next_request(time.monotonic())
+        except RequestError as error:
+            return self._reject_request(state, error)
+        finally:
+            state.phases.lap('parse')
+
+        if request is None:
+            if state.parser.pending:
+                self._set_connection_deadline(state, state.parser.deadline())
+            return
+
+        state.start_time = datetime.datetime.now()
+        state.request = request
+        state.requests_handled += 1
+
+        # Rate limiting, once the request is parsed and before it is
+        # handled or processed
+        if not self.rate_limiter.allow(state.addr[0]):
+            log_message(f'Throttling connection from {state.addr}', YELLOW)
+            self.detector.record_response(state.addr[0], 429)
+            return self._send_rejection(state, TOO_MANY_REQUESTS_RESPONSE, 429)
+
+        # The connection is neither read nor timed out while processing
+        self.selector.unregister(state.sock)
+        self.timer_wheel.cancel(state.timer)
+        state.processing = True
+        future = self.work_stage.submit(request)
+        future.add_done_callback(
+            lambda future: self._work_done(state, request, future)
+        )
+
+    def _work_done(self, state: _SelectorConnection, request, future) -> None:
+        # Called on a pool thread, hands the request back to the loop
+        self.finished_work.append((state, request, future))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            # A wake-up is already pending, or the server has stopped
+            pass
+
+    def _send_finished_work(self) -> None:
+        try:
+            while self.wakeup_reader.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.finished_work:
+            state, request, future = self.finished_work.popleft()
+            if state.sock in self.connections:
+                self._respond(state, request, future)
+
+    def _respond(self, state: _SelectorConnection, request, future) -> None:
+        # Runs the handler once the request's work is done
+        state.phases.lap('processing')
+        state.processing = False
+        self.selector.register(state.sock, selectors.EVENT_WRITE, state)
+
+        error = future.exception()
+        if error is not None:
+            log_message(f'Processing failed for {state.addr}: {error}', RED)
+            self.detector.record_response(state.addr[0], 500)
+            return self._send_rejection(state, RESPONSES.error(500), 500)
+
+        response_stream = ResponseBuffer()
+        try:
+            handler = self.request_handler(
+                response_stream=response_stream,
+                keep_alive=state.requests_handled < MAX_KEEPALIVE_REQUESTS,
+                request=request,
+                phases=state.phases
+            )
+            state.close_after = handler.close_connection
+            state.status_code = handler.status_code
+            self.detector.record_response(state.addr[0], handler.status_code)
+
+        except Exception as error:
+            log_message(f'Connection error from {state.addr}: {error}', RED)
+            return self._close_connection(state)
+
+        state.response = response_stream
+        self._set_connection_deadline(state, time.monotonic() + REQUEST_TIMEOUT)
+        self.selector.modify(state.sock, selectors.EVENT_WRITE, state)
+        self._write_response(state)
+
+    def _reject_request(
+        self,
+        state: _SelectorConnection,
+        error: RequestError
+    ) -> None:
+        log_message(f'Bad request from {state.addr}: {error}', YELLOW)
+        state.request = None
+        self._send_rejection(
+            state, RESPONSES.error(error.status_code), error.status_code
+        )
+
+    def _send_rejection(
+        self,
+        state: _SelectorConnection,
+        response: bytes,
+        status_code: int
+    ) -> None:
+        # Sends a canned response and closes, without processing.
+        # Whatever else the client sent is dropped
+        state.rejected = True
+        state.status_code = status_code
+        state.response = ResponseBuffer()
+        state.response.write(response)
+        self._set_connection_deadline(state, time.monotonic() + REQUEST_TIMEOUT)
+        self.selector.modify(state.sock, selectors.EVENT_WRITE, state)
+        self._write_response(state)
+
+    def _write_response(self, state: _SelectorConnection) -> None:
+        response = state.response
+        sent = response.sent
+        try:
+            done = response.send(state.sock)
+        except (BlockingIOError, InterruptedError):
+            done = False
+        except BrokenPipeError:
+            log_message(
+                f'Connection error from {state.addr}: Broken pipe (client disconnected)',
+                RED
+            )
+            return self._close_connection(state)
+        except OSError as error:
+            log_message(f'Connection error from {state.addr}: {error}', RED)
+            return self._close_connection(state)
+
+        if not done:
+            # The deadline only passes once the client stops reading
+            if response.sent != sent:
+                self._set_connection_deadline(state, time.monotonic() + REQUEST_TIMEOUT)
+            return
+
+        time_taken = (datetime.datetime.now() - state.start_time).total_seconds()
+        self._log_access(
+            state.addr, state.request, state.status_code,
+            state.response.length, time_taken
+        )
+        state.response = None
+        state.phases.lap('send')
+        if state.rejected:
+            return self._close_connection(state)
+        self._finish_request(state)
+
+    def _set_connection_deadline(self, state: _SelectorConnection, deadline: float) -> None:
+        # Each connection has one deadline at a time, replacing the last
+        state.timer = self.timer_wheel.reschedule(state.timer, deadline, state)
+
+    def _expire_connections(self, expired: list) -> None:
+        # Deals with the batch of connections whose deadline passed this tick
+        now = time.monotonic()
+        for state in expired:
+            # Rejected, or not reading its response
+            if state.rejected or state.response is not None:
+                if not state.rejected:
+                    self.timeouts.inc()
+                    log_message(f'Connection from {state.addr} timed out', YELLOW)
+                self._close_connection(state)
+                continue
+
+            if state.parser.pending:
+                self._reject_request(state, state.parser.expired(now))
+                continue
+
+            # Idle keep-alive connections expiring is not an error
+            if not state.idle:
+                self.timeouts.inc()
+                log_message(f'Connection from {state.addr} timed out', YELLOW)
+            self._close_connection(state)
+
+    def _finish_request(self, state: _SelectorConnection) -> None:
+        state.phases.finish()
+        end_time = datetime.datetime.now()
+        time_taken = (end_time - state.start_time).total_seconds()
+        self._record_latency(time_taken, state.status_code)
+        if time_taken > PROCESS_TIME + 1:
+            log_message(
+                f'Slow response: {time_taken:.2f}s for {state.addr}',
+                YELLOW
+            )
+
+        if state.close_after:
+            return self._close_connection(state)
+
+        # Wait for the next request, which may already be buffered
+        self._set_connection_deadline(state, time.monotonic() + KEEPALIVE_TIMEOUT)
+        self.selector.modify(state.sock, selectors.EVENT_READ, state)
+        self._handle_buffered_request(state)
+
+    def _close_connection(self, state: _SelectorConnection) -> None:
+        if self.connections.pop(state.sock, None) is None:
+            return
+
+        self.timer_wheel.cancel(state.timer)
+        if not state.processing:
+            self.selector.unregister(state.sock)
+        if state.response is not None:
+            state.response.close()
+        state.sock.close()
+        state.phases.lap('close')
+        state.phases.finish()
+        log_message(f'Closed connection from {state.addr}', BLUE)
+        self.update_connection_count(increment=False)
+
+        # Closing part way through a request, or before sending one at all
+        incomplete = state.parser.pending or (
+            state.requests_handled == 0 and not state.rejected
+        )
+        self.detector.record_close(
+            state.addr[0], time.monotonic() - state.opened, incomplete
+        )
+        self._release_slot()
+
+
+def simulate_processing(request: ParsedRequest) -> None:
+    # Stands in for real per-request work. Runs on the work stage
+    time.sleep(PROCESS_TIME)
+
+
+def _create_listen_socket(
+    socket_address: tuple[str, int],
+    reuse_port: bool = False
+) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(socket_address)
+    sock.listen()
+    return sock
+
+
+def _descriptor_budget() -> int:
+    # Descriptors left for client connections
+    if resource is None:
+        return sys.maxsize
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return sys.maxsize
+    return max(soft_limit - FD_HEADROOM, 0)
+
+
+SERVER_MODES = {
+    'threaded': TCPServer,
+    'selector': SelectorTCPServer
+}
+
+
+def run_tcp_server(
+    max_conns: int = MAX_CONNECTIONS,
+    mode: str = SERVER_MODE,
+    workers: int = NUM_WORKERS
+) -> None:
+    # Before forking, so workers share the loaded and compressed assets
+    ASSET_CACHE.preload(ROOT_DIR)
+
+    if workers > 1:
+        return run_prefork_server(max_conns, mode, workers)
+
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, SamplingProfiler().toggle)
+
+    server_class = SERVER_MODES[mode]
     try:
-        with TCPServer((LOCALHOST, PORT), HTTPRequestHandler, max_conns) as server:
-            log_message(f'TCP Server listening on address {LOCALHOST}:{PORT}')
+        with server_class(
+            (LOCALHOST, PORT),
+            HTTPRequestHandler,
+            max_conns,
+            metrics_port=METRICS_PORT
+        ) as server:
+            log_message(
+                f'TCP Server listening on address {LOCALHOST}:{PORT} ({mode})'
+            )
             server.serve_forever()
 
     except OSError as error:
-        if error.errno == 98:
+        _log_server_error(error)
+
+
+def run_prefork_server(max_conns: int, mode: str, workers: int) -> None:
+    # Forks the workers and supervises them until shut down. Workers bind
+    # the port themselves with SO_REUSEPORT, or share a socket opened here
+    # where it is unavailable. Shutdown signals are fanned out to every worker
+    shared_sock = None
+    if not REUSE_PORT_AVAILABLE:
+        try:
+            shared_sock = _create_listen_socket((LOCALHOST, PORT))
+        except OSError as error:
+            return _log_server_error(error)
+
+    # Rate limits and bans are enforced across all workers
+    client_table = SharedClientTable(REQUEST_LIMIT, TIME_WINDOW)
+
+    children = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(index, max_conns, mode, shared_sock, client_table)
+        children[pid] = index
+
+    def forward(signum, frame) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGTERM, stop)
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, forward)
+    log_message(f'Supervisor {os.getpid()} starting {workers} workers')
+    for index in range(workers):
+        spawn(index)
+
+    # The shared memory outlives the process unless unlinked, whatever
+    # ends the loop
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                stop(signal.SIGINT, None)
+                continue
+            except ChildProcessError:
+                break
+
+            # Not a worker, e.g. multiprocessing's resource tracker
+            if pid not in children:
+                continue
+            index = children.pop(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+            if stopping or exit_code == 0:
+                continue
+
+            # Crashed or killed, bring a replacement up in the same slot
             log_message(
-                f'Error: Address {LOCALHOST}:{PORT} is already in use', RED)
-        else:
-            log_message(f'An error occurred: {error}', RED)
+                f'Worker {index} (pid {pid}) exited with {exit_code}, restarting',
+                RED
+            )
+            time.sleep(WORKER_RESTART_DELAY)
+            if not stopping:
+                spawn(index)
+
+    finally:
+        # Workers still running if an exception ended it early
+        forward(signal.SIGTERM, None)
+        if shared_sock is not None:
+            shared_sock.close()
+        client_table.close(unlink=True)
+    log_message('Finished successfully', GREEN)
+
+
+def _run_worker(
+    index: int,
+    max_conns: int,
+    mode: str,
+    shared_sock: socket.socket | None,
+    client_table: SharedClientTable
+) -> None:
+    # Runs in the forked child and never returns. SIGTERM from the
+    # supervisor stops the server the same way Ctrl+C does
+    def terminate(signum, frame) -> None:
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, SamplingProfiler().toggle)
+    exit_code = 0
+    try:
+        server_class = SERVER_MODES[mode]
+        with server_class(
+            (LOCALHOST, PORT),
+            HTTPRequestHandler,
+            max_conns,
+            reuse_port=shared_sock is None,
+            sock=shared_sock,
+            rate_limiter=client_table,
+            metrics_port=METRICS_PORT + index if METRICS_PORT is not None else None
+        ) as server:
+            log_message(
+                f'Worker {index} (pid {os.getpid()}) listening on address '
+                f'{LOCALHOST}:{PORT} ({mode})'
+            )
+            server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    except OSError as error:
+        # Nonzero, so the supervisor starts a replacement
+        _log_server_error(error)
+        exit_code = 1
+
+    except Exception as error:
+        log_message(f'Worker {index} failed: {error}', RED)
+        exit_code = 1
+
+    finally:
+        # Exit handlers do not run, the log queue is flushed here
+        shutdown_logging()
+        os._exit(exit_code)
+
+
+def _limit_buffers(buffers: list, limit: int) -> list:
+    # The leading buffers holding at most limit bytes, the last one cut short
+    limited = []
+    for buffer in buffers:
+        if len(buffer) >= limit:
+            limited.append(memoryview(buffer)[:limit])
+            break
+        limited.append(buffer)
+        limit -= len(buffer)
+    return limited
+
+
+def _parse_http_date(value: str) -> int | None:
+    # Timestamp of an HTTP date, or None if it is invalid
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return int(date.timestamp())
+
+
+def _log_server_error(error: OSError) -> None:
+    if error.errno == 98:
+        log_message(
+            f'Error: Address {LOCALHOST}:{PORT} is already in use', RED)
+    else:
+        log_message(f'An error occurred: {error}', RED)
 
 
 if __name__ == '__main__':
-    max_conns = get_max_connections()
+    mode = sys.argv[1] if len(sys.argv) > 1 else SERVER_MODE
+    if mode not in SERVER_MODES:
+        exit(f"Invalid mode: expected one of {', '.join(SERVER_MODES)}")
+
+    try:
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_WORKERS
+    except ValueError:
+        exit("Invalid input: Number of workers must be an integer")
+
+    # Optional ceiling for the adaptive connection limit
+    try:
+        max_conns = int(sys.argv[3]) if len(sys.argv) > 3 else MAX_CONNECTIONS
+    except ValueError:
+        exit("Invalid input: Max connections must be an integer")
 
     log_message('Started simple unprotected TCP server')
-    run_tcp_server(max_conns)
+    run_tcp_server(max_conns, mode, workers)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# Setup shared by the tests, imported before any of the server's modules.
+# Those are imported flat, as tcp_server.py does. server_logs starts its
+# writer on import and writes its log file to the working directory, so
+# the tests run from a temporary directory, removed once they finish, and
+# records stay off the console
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+# Registered before server_logs' own exit handler, so it runs after the
+# last records are written
+WORK_DIR = tempfile.mkdtemp(prefix='dos-server-tests-')
+os.chdir(WORK_DIR)
+atexit.register(shutil.rmtree, WORK_DIR, True)
+
+import server_logs  # noqa: E402
+
+server_logs.LOG_TO_CONSOLE = False
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Tests for the admission queue's priorities, limits and CoDel shedding
+import unittest
+
+import support  # noqa: F401
+from admission_queue import AdmissionQueue
+
+
+class AdmissionQueueTest(unittest.TestCase):
+    def queue(self, **settings) -> AdmissionQueue:
+        settings = {
+            'max_depth': 10, 'max_wait': 100.0,
+            'target_delay': 1.0, 'interval': 5.0, **settings
+        }
+        return AdmissionQueue(**settings)
+
+    def drain(self, queue: AdmissionQueue, now: float) -> list:
+        items = []
+        while True:
+            item, dropped = queue.dequeue(now)
+            self.assertEqual(dropped, [])
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_priority_then_fifo(self):
+        queue = self.queue()
+        for item, priority in (('u1', 1), ('s1', 2), ('t1', 0), ('u2', 1), ('t2', 0)):
+            self.assertEqual(queue.enqueue(item, priority, 0.0), [])
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(self.drain(queue, 0.5), ['t1', 't2', 'u1', 'u2', 's1'])
+        self.assertEqual(len(queue), 0)
+
+    def test_full_queue(self):
+        queue = self.queue(max_depth=3)
+        queue.enqueue('t1', 0, 0.0)
+        queue.enqueue('s1', 2, 0.0)
+        queue.enqueue('s2', 2, 0.0)
+
+        # Refused when nothing of a lower class waits
+        self.assertEqual(queue.enqueue('s3', 2, 0.0), ['s3'])
+        # Otherwise the newest of the lowest class makes room
+        self.assertEqual(queue.enqueue('u1', 1, 0.0), ['s2'])
+        self.assertEqual(queue.enqueue('t2', 0, 0.0), ['s1'])
+        self.assertEqual(queue.enqueue('t3', 0, 0.0), ['u1'])
+        self.assertEqual(queue.enqueue('t4', 0, 0.0), ['t4'])
+
+        stats = queue.stats()
+        self.assertEqual((stats['overflowed'], stats['shed']), (2, 3))
+        self.assertEqual(self.drain(queue, 0.5), ['t1', 't2', 't3'])
+
+    def test_expire(self):
+        queue = self.queue(max_wait=10.0)
+        queue.enqueue('a', 1, 0.0)
+        queue.enqueue('b', 0, 5.0)
+        queue.enqueue('c', 1, 8.0)
+
+        self.assertEqual(queue.expire(10.0), [])
+        self.assertEqual(queue.expire(10.5), ['a'])
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.stats()['expired'], 1)
+
+    def test_dequeue_drops_expired(self):
+        queue = self.queue(max_wait=10.0, target_delay=100.0)
+        queue.enqueue('a', 0, 0.0)
+        queue.enqueue('b', 0, 5.0)
+        self.assertEqual(queue.dequeue(12.0), ('b', ['a']))
+
+    def test_reclassify(self):
+        queue = self.queue()
+        queue.enqueue('a', 1, 0.0)
+        queue.enqueue('b', 0, 1.0)
+        queue.enqueue('c', 1, 2.0)
+        queue.enqueue('d', 2, 3.0)
+
+        # 'a' becomes trusted, 'c' is banned. 'a' still waited longest,
+        # so it goes ahead of 'b' in the trusted class
+        classes = {'a': 0, 'b': 0, 'c': None, 'd': 1}
+        self.assertEqual(queue.reclassify(classes.get), ['c'])
+        self.assertEqual(queue.stats()['removed'], 1)
+        self.assertEqual(queue.stats()['depth_by_priority'], [2, 1, 0])
+        self.assertEqual(self.drain(queue, 4.0), ['a', 'b', 'd'])
+
+    def test_codel_sheds_standing_queue(self):
+        queue = self.queue()
+        for item in 'abcde':
+            queue.enqueue(item, 1, 0.0)
+
+        # Above target, but not yet for a whole interval
+        self.assertEqual(queue.dequeue(2.0), ('a', []))
+        # Still above target an interval later: the newest is shed
+        self.assertEqual(queue.dequeue(8.0), ('b', ['e']))
+        # Until the next drop, interval / sqrt(1) later
+        self.assertEqual(queue.dequeue(9.0), ('c', []))
+        self.assertEqual(queue.dequeue(13.0), (None, ['d']))
+        self.assertEqual(queue.stats()['shed'], 2)
+
+    def test_codel_stops_below_target(self):
+        queue = self.queue()
+        queue.enqueue('a', 1, 0.0)
+        self.assertEqual(queue.dequeue(2.0), ('a', []))
+
+        # A short wait resets the state, so a later long one is not shed
+        queue.enqueue('b', 1, 10.0)
+        self.assertEqual(queue.dequeue(10.5), ('b', []))
+        queue.enqueue('c', 1, 11.0)
+        queue.enqueue('d', 1, 11.0)
+        self.assertEqual(queue.dequeue(14.0), ('c', []))
+
+    def test_clear(self):
+        queue = self.queue()
+        queue.enqueue('a', 0, 0.0)
+        queue.enqueue('b', 2, 0.0)
+        self.assertEqual(sorted(queue.clear()), ['a', 'b'])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.dequeue(1.0), (None, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# Tests for the radix trie against a brute force search, and for the
+# blocklist's live ranges and file reloads
+import os
+import random
+import tempfile
+import time
+import unittest
+
+import support  # noqa: F401
+from blocklist import Blocklist, PERMANENT, _RadixTrie
+
+
+BITS = 12
+
+
+class RadixTrieTest(unittest.TestCase):
+    def covered(self, ranges: dict, address: int, now: float) -> bool:
+        # Brute force: any unexpired (prefix, length) range covering it
+        return any(
+            expires > now and address >> (BITS - length) == prefix
+            for (prefix, length), expires in ranges.items()
+        )
+
+    def check_all(self, trie: _RadixTrie, ranges: dict, now: float) -> None:
+        for address in range(1 << BITS):
+            self.assertEqual(
+                trie.contains(address, now),
+                self.covered(ranges, address, now),
+                f'address {address:0{BITS}b}'
+            )
+        self.assertEqual(trie.size, len(ranges))
+
+    def test_against_brute_force(self):
+        rng = random.Random(1)
+        for _ in range(20):
+            trie = _RadixTrie(BITS)
+            ranges = {}
+            for _ in range(rng.randrange(1, 40)):
+                length = rng.randint(0, BITS)
+                prefix = rng.getrandbits(length) if length else 0
+                expires = rng.choice([PERMANENT, 5.0, 15.0])
+                trie.insert(prefix, length, expires)
+                ranges[prefix, length] = expires
+            self.check_all(trie, ranges, 10.0)
+
+            # Removing keeps the trie consistent with the ranges left
+            for key in rng.sample(sorted(ranges), len(ranges) // 2):
+                self.assertTrue(trie.remove(*key))
+                del ranges[key]
+            self.check_all(trie, ranges, 10.0)
+
+    def test_remove_missing(self):
+        trie = _RadixTrie(BITS)
+        trie.insert(0b1010, 4, PERMANENT)
+        trie.insert(0b1011, 4, PERMANENT)
+        # Only the node joining the two ranges is at 0b101/3
+        self.assertFalse(trie.remove(0b101, 3))
+        self.assertFalse(trie.remove(0b1100, 4))
+        self.assertEqual(trie.size, 2)
+
+    def test_reinsert_updates_expiry(self):
+        trie = _RadixTrie(BITS)
+        trie.insert(0b1, 1, 5.0)
+        trie.insert(0b1, 1, PERMANENT)
+        self.assertEqual(trie.size, 1)
+        self.assertTrue(trie.contains(1 << (BITS - 1), 10.0))
+
+
+class BlocklistTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'blocklist.txt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, contents: str, mtime_ns: int) -> None:
+        # Explicit modification times, so a rewrite within the clock's
+        # resolution is still seen as a change
+        with open(self.path, 'w') as f:
+            f.write(contents)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def open_blocklist(self) -> Blocklist:
+        # The reload thread never runs during a test, refresh() is called
+        blocklist = Blocklist(self.path, reload_interval=3600)
+        self.addCleanup(blocklist.close)
+        return blocklist
+
+    def test_live_ranges(self):
+        blocklist = Blocklist()
+        blocklist.add('10.0.0.0/8')
+        blocklist.add('2001:db8::/32')
+        blocklist.add('192.0.2.1')
+
+        self.assertTrue(blocklist.contains('10.255.0.1'))
+        self.assertFalse(blocklist.contains('11.0.0.1'))
+        self.assertTrue(blocklist.contains('2001:db8::1'))
+        self.assertFalse(blocklist.contains('2001:db9::1'))
+        self.assertTrue(blocklist.contains('192.0.2.1'))
+        self.assertFalse(blocklist.contains('192.0.2.2'))
+        self.assertFalse(blocklist.contains('not an address'))
+
+        self.assertTrue(blocklist.remove('10.0.0.0/8'))
+        self.assertFalse(blocklist.remove('10.0.0.0/8'))
+        self.assertFalse(blocklist.contains('10.255.0.1'))
+        self.assertEqual(len(blocklist), 2)
+
+    def test_ttl(self):
+        blocklist = Blocklist()
+        blocklist.add('198.51.100.0/24', ttl=0)
+        blocklist.add('203.0.113.0/24', ttl=3600)
+        self.assertFalse(blocklist.contains('198.51.100.1'))
+        self.assertTrue(blocklist.contains('203.0.113.1'))
+
+        self.assertEqual(blocklist.purge_expired(), 1)
+        self.assertEqual(len(blocklist), 1)
+
+    def test_ttl_extended(self):
+        # A range added again replaces its expiry, the old one is not purged
+        blocklist = Blocklist()
+        blocklist.add('198.51.100.0/24', ttl=0)
+        blocklist.add('198.51.100.0/24', ttl=3600)
+        self.assertEqual(blocklist.purge_expired(), 0)
+        self.assertTrue(blocklist.contains('198.51.100.1'))
+
+    def test_file(self):
+        self.write(
+            '# comment\n'
+            '10.0.0.0/8\n'
+            '::1  # loopback\n'
+            'not-a-network\n'
+            '192.0.2.1 -5\n'
+            '198.51.100.0/24 0\n',
+            10**9
+        )
+        blocklist = self.open_blocklist()
+
+        self.assertTrue(blocklist.contains('10.1.2.3'))
+        self.assertTrue(blocklist.contains('::1'))
+        # Invalid lines are skipped, and a TTL of 0 has run out already
+        self.assertFalse(blocklist.contains('192.0.2.1'))
+        self.assertFalse(blocklist.contains('198.51.100.1'))
+        self.assertEqual(len(blocklist), 3)
+
+    def test_reload(self):
+        self.write('10.0.0.0/8\n', 10**9)
+        blocklist = self.open_blocklist()
+        blocklist.add('192.0.2.1')
+
+        self.write('11.0.0.0/8\n', 2 * 10**9)
+        blocklist.refresh()
+        self.assertFalse(blocklist.contains('10.1.2.3'))
+        self.assertTrue(blocklist.contains('11.1.2.3'))
+        # Live ranges are not the file's to replace
+        self.assertTrue(blocklist.contains('192.0.2.1'))
+
+        os.remove(self.path)
+        blocklist.refresh()
+        self.assertFalse(blocklist.contains('11.1.2.3'))
+        self.assertTrue(blocklist.contains('192.0.2.1'))
+
+    def test_unchanged_file_not_reloaded(self):
+        self.write('10.0.0.0/8\n', 10**9)
+        blocklist = self.open_blocklist()
+        tries = blocklist.file_tries
+
+        blocklist.refresh()
+        self.assertIs(blocklist.file_tries, tries)
+
+    def test_unreadable_file_keeps_ranges(self):
+        self.write('10.0.0.0/8\n', 10**9)
+        blocklist = self.open_blocklist()
+
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff\xfe\n')
+        os.utime(self.path, ns=(2 * 10**9, 2 * 10**9))
+        blocklist.refresh()
+        self.assertTrue(blocklist.contains('10.1.2.3'))
+
+        # Retried until it can be read
+        self.write('11.0.0.0/8\n', 2 * 10**9)
+        blocklist.refresh()
+        self.assertTrue(blocklist.contains('11.1.2.3'))
+
+    def test_reload_thread(self):
+        self.write('10.0.0.0/8\n', 10**9)
+        blocklist = Blocklist(self.path, reload_interval=0.01)
+        self.addCleanup(blocklist.close)
+
+        self.write('11.0.0.0/8\n', 2 * 10**9)
+        deadline = time.monotonic() + 5
+        while not blocklist.contains('11.1.2.3') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(blocklist.contains('11.1.2.3'))
+        self.assertFalse(blocklist.contains('10.1.2.3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Tests for Range header parsing and multipart/byteranges bodies
+import unittest
+
+import support  # noqa: F401
+from byte_ranges import MAX_RANGES, MULTIPART_BOUNDARY, multipart_parts, parse_range
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_single_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range('bytes=500-', 1000), [(500, 999)])
+        self.assertEqual(parse_range('bytes=900-2000', 1000), [(900, 999)])
+        self.assertEqual(parse_range('BYTES = 1-1', 1000), [(1, 1)])
+
+    def test_suffix_ranges(self):
+        self.assertEqual(parse_range('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_range('bytes=-5000', 1000), [(0, 999)])
+        self.assertEqual(parse_range('bytes=-0', 1000), [])
+        self.assertEqual(parse_range('bytes=-10', 0), [])
+
+    def test_unsatisfiable(self):
+        # An empty list is answered 416
+        self.assertEqual(parse_range('bytes=1000-', 1000), [])
+        self.assertEqual(parse_range('bytes=1000-1100,2000-', 1000), [])
+
+    def test_unsatisfiable_ranges_dropped(self):
+        self.assertEqual(parse_range('bytes=0-9,5000-6000', 1000), [(0, 9)])
+
+    def test_ignored_headers(self):
+        # None means the whole representation is sent
+        for header in (
+            'items=0-9',
+            'bytes',
+            'bytes=',
+            'bytes=-',
+            'bytes=10',
+            'bytes=9-0',
+            'bytes=a-9',
+            'bytes=0-9a',
+            'bytes=+1-9',
+            'bytes=0-9,,20-29'
+        ):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, 1000))
+
+    def test_merges_overlapping_and_adjacent(self):
+        self.assertEqual(
+            parse_range('bytes=50-99,0-49,200-299,250-260,-100', 1000),
+            [(0, 99), (200, 299), (900, 999)]
+        )
+        self.assertEqual(parse_range('bytes=0-0,0-0,0-0', 1000), [(0, 0)])
+
+    def test_too_many_ranges(self):
+        within = ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(MAX_RANGES))
+        self.assertEqual(len(parse_range(f'bytes={within}', 1000)), MAX_RANGES)
+        self.assertIsNone(parse_range(f'bytes={within},500-501', 1000))
+
+
+class MultipartPartsTest(unittest.TestCase):
+    def test_parts_and_length(self):
+        body = bytes(range(256)) * 4
+        ranges = [(0, 9), (100, 199), (1000, 1023)]
+        parts, closing, length = multipart_parts(ranges, 'text/plain', len(body))
+
+        self.assertEqual([(offset, count) for _, offset, count in parts], [
+            (0, 10), (100, 100), (1000, 24)
+        ])
+        assembled = b''.join(
+            head + body[offset:offset + count] for head, offset, count in parts
+        ) + closing
+        self.assertEqual(len(assembled), length)
+
+        head = parts[1][0].decode()
+        self.assertTrue(head.startswith(f'\r\n--{MULTIPART_BOUNDARY}\r\n'))
+        self.assertIn('Content-Type: text/plain\r\n', head)
+        self.assertIn('Content-Range: bytes 100-199/1024\r\n', head)
+        self.assertEqual(closing, f'\r\n--{MULTIPART_BOUNDARY}--\r\n'.encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
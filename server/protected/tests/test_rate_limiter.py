@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Tests for the GCRA rate limiter and its bans
+import unittest
+
+import support  # noqa: F401
+from rate_limiter import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_burst_then_refill(self):
+        # 10 requests per 30 seconds: a burst of 10, then one every 3s
+        limiter = RateLimiter(10, 30)
+        self.assertTrue(all(limiter.allow('a', 100.0) for _ in range(10)))
+        self.assertFalse(limiter.allow('a', 100.0))
+
+        self.assertFalse(limiter.allow('a', 102.9))
+        self.assertTrue(limiter.allow('a', 103.0))
+        self.assertFalse(limiter.allow('a', 103.0))
+        self.assertTrue(limiter.allow('a', 106.0))
+
+    def test_full_refill(self):
+        limiter = RateLimiter(10, 30)
+        for _ in range(10):
+            limiter.allow('a', 100.0)
+        self.assertTrue(all(limiter.allow('a', 130.0) for _ in range(10)))
+        self.assertFalse(limiter.allow('a', 130.0))
+
+    def test_denied_requests_not_charged(self):
+        # Retrying while throttled does not push the next slot back
+        limiter = RateLimiter(2, 10)
+        limiter.allow('a', 0.0)
+        limiter.allow('a', 0.0)
+        for now in (1.0, 2.0, 3.0, 4.0):
+            self.assertFalse(limiter.allow('a', now))
+        self.assertTrue(limiter.allow('a', 5.0))
+
+    def test_clients_independent(self):
+        limiter = RateLimiter(1, 10)
+        self.assertTrue(limiter.allow('a', 0.0))
+        self.assertFalse(limiter.allow('a', 0.0))
+        self.assertTrue(limiter.allow('b', 0.0))
+
+    def test_matches_token_bucket(self):
+        # GCRA allows the same requests as a bucket of `limit` tokens
+        # refilled continuously over the window
+        limit, window = 5, 10.0
+        limiter = RateLimiter(limit, window)
+        tokens, last = float(limit), 0.0
+        for step in range(400):
+            now = step * 0.37
+            tokens = min(limit, tokens + (now - last) * limit / window)
+            last = now
+            expected = tokens >= 1 - 1e-9
+            if expected:
+                tokens -= 1
+            self.assertEqual(limiter.allow('a', now), expected, f'at {now}')
+
+    def test_idle_clients_expire(self):
+        limiter = RateLimiter(10, 30)
+        for client in ('a', 'b', 'c'):
+            limiter.allow(client, 0.0)
+        self.assertEqual(len(limiter), 3)
+        # Past their arrival times they are dropped on later calls
+        limiter.allow('d', 10.0)
+        self.assertEqual(len(limiter), 1)
+
+    def test_max_clients(self):
+        limiter = RateLimiter(10, 30, max_clients=3)
+        for index in range(10):
+            limiter.allow(str(index), 0.0)
+        self.assertEqual(len(limiter), 3)
+
+    def test_bans(self):
+        limiter = RateLimiter(10, 30)
+        limiter.ban('a', 3600)
+        limiter.ban('b', 0)
+        self.assertTrue(limiter.is_banned('a'))
+        self.assertFalse(limiter.is_banned('b'))
+        self.assertFalse(limiter.is_banned('c'))
+
+        # A shorter ban never cuts a longer one short
+        limiter.ban('a', 0)
+        self.assertTrue(limiter.is_banned('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
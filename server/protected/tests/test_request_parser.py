@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Tests for the incremental request head parser
+import unittest
+from http import HTTPStatus
+
+import support  # noqa: F401
+from request_parser import RequestParser, RequestError
+
+
+class RequestParserTest(unittest.TestCase):
+    def parse(self, data: bytes, **limits):
+        parser = RequestParser(**limits)
+        parser.feed(data, 0.0)
+        return parser.next_request(0.0)
+
+    def test_request_line_and_headers(self):
+        request = self.parse(
+            b'GET /index.html HTTP/1.1\r\nHost: example\r\nAccept:  */*  \r\n\r\n'
+        )
+        self.assertEqual(request.command, 'GET')
+        self.assertEqual(request.path, '/index.html')
+        self.assertEqual(request.version, 'HTTP/1.1')
+        self.assertEqual(request.headers, {'host': 'example', 'accept': '*/*'})
+
+    def test_bare_lf_line_endings(self):
+        request = self.parse(b'GET / HTTP/1.1\nHost: example\n\n')
+        self.assertEqual(request.headers, {'host': 'example'})
+
+    def test_non_ascii_header_value(self):
+        # The UTF-8 encoding of Å is C3 85, and 0x85 is a line break to
+        # str.splitlines() once decoded as latin-1
+        value = 'Åsa'.encode()
+        request = self.parse(b'GET / HTTP/1.1\r\nX-Name: ' + value + b'\r\n\r\n')
+        self.assertEqual(request.headers['x-name'].encode('latin-1'), value)
+
+    def test_control_bytes_in_header_value(self):
+        request = self.parse(b'GET / HTTP/1.1\r\nX-Data: a\x1cb\x1dc\x1ed\x0be\r\n\r\n')
+        self.assertEqual(request.headers['x-data'], 'a\x1cb\x1dc\x1ed\x0be')
+
+    def test_incomplete_head(self):
+        parser = RequestParser()
+        parser.feed(b'GET / HTTP/1.1\r\nHost: exa', 0.0)
+        self.assertIsNone(parser.next_request(0.0))
+        self.assertTrue(parser.pending)
+
+        parser.feed(b'mple\r\n\r', 0.5)
+        self.assertIsNone(parser.next_request(0.5))
+        parser.feed(b'\n', 1.0)
+        self.assertEqual(parser.next_request(1.0).headers, {'host': 'example'})
+        self.assertFalse(parser.pending)
+
+    def test_pipelined_requests(self):
+        parser = RequestParser()
+        parser.feed(b'GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c', 0.0)
+        self.assertEqual(parser.next_request(0.0).path, '/a')
+        self.assertEqual(parser.next_request(0.0).path, '/b')
+        self.assertIsNone(parser.next_request(0.0))
+        self.assertTrue(parser.pending)
+
+    def test_invalid_request_line(self):
+        with self.assertRaises(RequestError) as caught:
+            self.parse(b'GET /\r\n\r\n')
+        self.assertEqual(caught.exception.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_invalid_header_line(self):
+        with self.assertRaises(RequestError) as caught:
+            self.parse(b'GET / HTTP/1.1\r\nno separator\r\n\r\n')
+        self.assertEqual(caught.exception.status_code, HTTPStatus.BAD_REQUEST)
+
+    def test_head_too_large(self):
+        # Refused before the head is complete
+        with self.assertRaises(RequestError) as caught:
+            self.parse(b'GET / HTTP/1.1\r\nX: ' + b'a' * 200, max_header_size=100)
+        self.assertEqual(
+            caught.exception.status_code,
+            HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE
+        )
+
+    def test_too_many_headers(self):
+        head = b'GET / HTTP/1.1\r\n' + b'X: 1\r\n' * 5 + b'\r\n'
+        with self.assertRaises(RequestError) as caught:
+            self.parse(head, max_header_count=4)
+        self.assertEqual(
+            caught.exception.status_code,
+            HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE
+        )
+        self.assertIsNotNone(self.parse(head, max_header_count=5))
+
+    def test_deadline(self):
+        # The earlier of the total deadline and the minimum data rate
+        parser = RequestParser(header_deadline=10.0, min_data_rate=50)
+        parser.feed(b'GET / HTTP/1.1\r\n', 100.0)
+        self.assertAlmostEqual(parser.deadline(), 100.0 + 2.0 + 16 / 50)
+
+        parser.feed(b'X: ' + b'a' * 1000, 101.0)
+        self.assertAlmostEqual(parser.deadline(), 110.0)
+        self.assertEqual(
+            parser.expired(111.0).status_code, HTTPStatus.REQUEST_TIMEOUT
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Tests for the hashed timing wheel
+import unittest
+
+import support  # noqa: F401
+from timer_wheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        # Whole second ticks keep the deadlines exact. The wheel starts at
+        # the current tick of the monotonic clock
+        self.wheel = TimerWheel(tick=1.0, num_slots=8)
+        self.start = float(self.wheel.current)
+
+    def test_due_at_deadline_tick(self):
+        self.wheel.schedule(self.start + 2.5, 'a')
+        self.wheel.schedule(self.start + 3.0, 'b')
+        self.wheel.schedule(self.start + 1.0, 'c')
+
+        self.assertEqual(self.wheel.advance(self.start + 0.9), [])
+        self.assertEqual(self.wheel.advance(self.start + 1.0), ['c'])
+        self.assertEqual(self.wheel.advance(self.start + 2.9), [])
+        self.assertEqual(sorted(self.wheel.advance(self.start + 3.0)), ['a', 'b'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_past_deadline_due_on_next_tick(self):
+        self.wheel.schedule(self.start - 100.0, 'a')
+        self.assertEqual(self.wheel.advance(self.start + 1.0), ['a'])
+
+    def test_cancel_and_reschedule(self):
+        a = self.wheel.schedule(self.start + 2.0, 'a')
+        b = self.wheel.schedule(self.start + 2.0, 'b')
+        self.wheel.cancel(a)
+        self.wheel.cancel(None)
+        b = self.wheel.reschedule(b, self.start + 4.0, 'b')
+        self.assertEqual(len(self.wheel), 1)
+
+        self.assertEqual(self.wheel.advance(self.start + 3.0), [])
+        self.assertEqual(self.wheel.advance(self.start + 4.0), ['b'])
+        # Cancelling a timer that already fired does nothing
+        self.wheel.cancel(b)
+
+    def test_deadline_beyond_wheel(self):
+        # 8 slots: a deadline 20 ticks away shares a slot with nearer ones
+        # and waits for its own tick
+        self.wheel.schedule(self.start + 20.0, 'far')
+        self.wheel.schedule(self.start + 4.0, 'near')
+        self.assertEqual(self.wheel.advance(self.start + 12.0), ['near'])
+        self.assertEqual(self.wheel.advance(self.start + 19.0), [])
+        self.assertEqual(self.wheel.advance(self.start + 20.0), ['far'])
+
+    def test_long_gap_between_advances(self):
+        # More ticks passed than there are slots, every slot is swept once
+        for offset in (1.0, 5.0, 7.0, 30.0):
+            self.wheel.schedule(self.start + offset, offset)
+        self.assertEqual(sorted(self.wheel.advance(self.start + 25.0)), [1.0, 5.0, 7.0])
+        self.assertEqual(self.wheel.advance(self.start + 30.0), [30.0])
+
+    def test_time_going_back_is_ignored(self):
+        self.wheel.advance(self.start + 5.0)
+        self.wheel.schedule(self.start + 1.0, 'a')
+        self.assertEqual(self.wheel.advance(self.start + 2.0), [])
+        self.assertEqual(self.wheel.advance(self.start + 6.0), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# Helper threads that leave the shutdown signals to the main thread.
+# Python only runs signal handlers on the main thread, but the kernel hands
+# a signal sent to the process to any thread not blocking it. One taken by
+# a helper thread leaves the main thread asleep in accept() or wait(), and
+# Ctrl+C or SIGTERM never stops the process.
+# - Threads inherit the signal mask of the thread starting them, so those
+#   started from a helper thread (metrics handlers, pool workers) block the
+#   signals as well
+# - Pools started from the main thread block them in their initializer
+import signal
+import threading
+from typing import Callable
+
+
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+SIGMASK_AVAILABLE = hasattr(signal, 'pthread_sigmask')
+
+
+def start_thread(target: Callable, *args, name: str | None = None) -> threading.Thread:
+    # Starts target(*args) on a daemon thread, with the shutdown signals
+    # blocked from its first instruction
+    thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+    if not SIGMASK_AVAILABLE:
+        thread.start()
+        return thread
+
+    previous = signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+    try:
+        thread.start()
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, previous)
+    return thread
+
+
+def block_shutdown_signals() -> None:
+    # For threads started elsewhere, e.g. as a thread pool's initializer
+    if SIGMASK_AVAILABLE:
+        signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Hashed timing wheel tracking the deadlines of every open connection.
+# Time is cut into ticks of TIMER_TICK seconds and each timer goes into the
+# slot for its tick, modulo NUM_SLOTS. Scheduling and cancelling are O(1)
+# set operations, and advancing the wheel only looks at the slots for the
+# ticks that passed, so the cost doesn't grow with the number of timers
+# that are not due. Everything due is returned together so the caller can
+# deal with the whole batch in one sweep.
+# Deadlines more than NUM_SLOTS ticks away share a slot with nearer ones
+# and simply stay put until their own tick comes round
+import math
+import time
+import threading
+
+
+TIMER_TICK = 0.1
+NUM_SLOTS = 512
+
+
+class Timer:
+    __slots__ = ('tick', 'item', 'slot')
+
+    def __init__(self, tick: int, item, slot: set) -> None:
+        self.tick = tick
+        self.item = item
+        self.slot = slot
+
+
+class TimerWheel:
+    def __init__(
+        self,
+        tick: float = TIMER_TICK,
+        num_slots: int = NUM_SLOTS
+    ) -> None:
+        self.tick = tick
+        self.slots = [set() for _ in range(num_slots)]
+        # Last tick that has been expired
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, deadline: float, item) -> Timer:
+        # Returns a handle for cancel(). Deadlines in the past expire on
+        # the next advance
+        with self.lock:
+            tick = max(math.ceil(deadline / self.tick), self.current + 1)
+            slot = self.slots[tick % len(self.slots)]
+            timer = Timer(tick, item, slot)
+            slot.add(timer)
+            return timer
+
+    def cancel(self, timer: Timer | None) -> None:
+        if timer is None:
+            return
+        with self.lock:
+            timer.slot.discard(timer)
+
+    def reschedule(self, timer: Timer | None, deadline: float, item) -> Timer:
+        self.cancel(timer)
+        return self.schedule(deadline, item)
+
+    def advance(self, now: float) -> list:
+        # Removes and returns the items of every timer due by now
+        target = int(now / self.tick)
+        expired = []
+        with self.lock:
+            ticks = min(target - self.current, len(self.slots))
+            for tick in range(self.current + 1, self.current + 1 + ticks):
+                slot = self.slots[tick % len(self.slots)]
+                due = [timer for timer in slot if timer.tick <= target]
+                for timer in due:
+                    slot.discard(timer)
+                    expired.append(timer.item)
+            self.current = max(self.current, target)
+        return expired
+
+    def __len__(self) -> int:
+        return sum(len(slot) for slot in self.slots)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Work stage running each request's processing on a pool of fixed size,
+# apart from the threads or event loop doing connection I/O. The pool is
+# threads for blocking or I/O-bound work and processes for CPU-bound work
+# (the work function and request must then be picklable). Connection
+# handling and processing can be sized and measured separately, and the
+# reply goes out as soon as the work has finished
+import time
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+
+from threads import block_shutdown_signals
+
+
+WORK_WORKERS = 32
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
+
+
+class WorkStage:
+    def __init__(
+        self,
+        work: Callable,
+        workers: int = WORK_WORKERS,
+        executor: str = 'thread'
+    ) -> None:
+        # work(request) is called once per request before it is answered
+        self.work = work
+        if executor == 'thread':
+            # Pool threads may be started from the main thread, which has
+            # to be the one taking the shutdown signals
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, initializer=block_shutdown_signals
+            )
+        else:
+            self.executor = EXECUTORS[executor](max_workers=workers)
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.work_time = 0.0
+
+    def submit(self, request) -> Future:
+        # Callbacks added to the future run on a pool thread when it is done
+        started = time.monotonic()
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self.work, request)
+        future.add_done_callback(lambda future: self._done(future, started))
+        return future
+
+    def run(self, request):
+        # Waits for the work, for callers that block anyway
+        return self.submit(request).result()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        # work_time includes time spent waiting for a free pool worker
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'work_time': self.work_time
+            }
+
+    def _done(self, future: Future, started: float) -> None:
+        with self.lock:
+            self.pending -= 1
+            self.work_time += time.monotonic() - started
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1